@@ -1,12 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
-from typing import Optional
-import logging
-from concurrent.futures import ThreadPoolExecutor
+from fastapi import APIRouter, Depends, HTTPException, Response
 import asyncio
+import logging
+import orjson
 
 from api.models.schemas import Query, AgentResponse
 from core.agent_manager_sequential import AgentManagerSequential
 from config.settings import get_settings
+from tools.db_tools import invalidate_schema_cache, query_database_bulk
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
@@ -18,7 +18,9 @@ router = APIRouter(
 
 # Create a singleton agent manager
 _agent_manager = None
-_executor = ThreadPoolExecutor(max_workers=1)
+
+# Gates how many queries run the full multi-agent workflow at once; extra requests wait their turn.
+_inflight_queries = asyncio.Semaphore(settings.MAX_CONVERSATIONS)
 
 
 def get_agent_manager() -> AgentManagerSequential:
@@ -36,7 +38,7 @@ def get_agent_manager() -> AgentManagerSequential:
             model=settings.LLM_MODEL,
             temperature=settings.LLM_TEMPERATURE
         )
-        print("instantiated AgentManagerSequential object")
+        logger.debug("instantiated AgentManagerSequential object")
     return _agent_manager
 
 
@@ -58,14 +60,9 @@ async def process_query(
     logger.info(f"Console: Received query in agent.py endpoint: {query.query}") # Goes to console
     
     try:
-        loop = asyncio.get_running_loop()
-        
-        # --- PASS req_logger TO agent_manager.process_query ---
-        api_response = await loop.run_in_executor(
-            _executor,
-            agent_manager.process_query, # This is AgentManager.process_query
-            query.query,
-        )
+        # The agent manager is fully async, so the request is awaited on the event loop directly
+        async with _inflight_queries:
+            api_response = await agent_manager.process_query(query.query)
         
         logger.info("API Endpoint: agent_manager.process_query returned.")
         return api_response # AgentResponse instance is already returned
@@ -81,6 +78,44 @@ async def process_query(
         )
 
 
+@router.post("/query/csv")
+async def process_query_csv(
+    query: Query,
+    agent_manager: AgentManagerSequential = Depends(get_agent_manager),
+) -> Response:
+    """
+    Process a query through the database agent system and export the chosen SQL's result as CSV.
+
+    The agent's answer only carries the first QUERY_MAX_ROWS rows; here the selected query
+    is run again through query_database_bulk, up to QUERY_BULK_MAX_ROWS rows.
+
+    Args:
+        query (Query): The user query to process
+        agent_manager (AgentManager): The agent manager dependency
+
+    Returns:
+        Response: text/csv with X-Row-Count and X-Truncated headers
+    """
+    logger.info(f"Console: Received CSV export query: {query.query}")
+    async with _inflight_queries:
+        api_response = await agent_manager.process_query(query.query)
+
+    try:
+        final_query = orjson.loads(api_response.final_answer)["final_query"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        raise HTTPException(status_code=500, detail=f"Error processing query: {api_response.final_answer}")
+
+    export = await asyncio.to_thread(query_database_bulk, final_query)
+    if "error" in export:
+        logger.error(f"API Endpoint: CSV export failed: {export['error']}")
+        raise HTTPException(status_code=500, detail=f"Error exporting query result: {export['error']}")
+    return Response(
+        content=export["csv"],
+        media_type="text/csv",
+        headers={"X-Row-Count": str(export["row_count"]), "X-Truncated": str(export["truncated"]).lower()},
+    )
+
+
 @router.get("/health")
 def agent_health() -> dict:
     """
@@ -88,3 +123,14 @@ def agent_health() -> dict:
     """
     logger.info("API Endpoint: Agent health check.")
     return {"status": "ok", "model": settings.LLM_MODEL}
+
+
+@router.post("/cache/invalidate")
+def invalidate_metadata_cache() -> dict:
+    """
+    Drops the cached schema and data dictionary lookups, e.g. after a migration.
+    Otherwise they are refreshed every SCHEMA_CACHE_TTL_SEC seconds.
+    """
+    logger.info("API Endpoint: Metadata cache invalidation requested.")
+    invalidate_schema_cache()
+    return {"status": "ok"}
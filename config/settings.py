@@ -1,5 +1,7 @@
-from pydantic_settings import BaseSettings
-from typing import List
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, NoDecode
+from typing import Annotated, List, Literal, Optional
+import json
 import os
 from functools import lru_cache
 
@@ -11,37 +13,64 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_HOST: str
     DB_PORT: str = "5432"
-    DB_SCHEMAS: List[str] = ["public"]
+    DB_SCHEMAS: Annotated[List[str], NoDecode] = ["public"]
 
     # Connection pool settings
     DB_MIN_POOL_SIZE: int = 10
-    DB_MAX_POOL_SIZE: int = 50
-    DB_POOL_TIMEOUT: int = 30
+    DB_MAX_POOL_SIZE: int = 50  # Kept under Postgres' default max_connections; extra callers queue for DB_POOL_TIMEOUT
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection before failing
+    DB_KEEPALIVES_IDLE: int = 30  # Seconds of idle time before TCP keepalives are sent
+    DB_KEEPALIVES_INTERVAL: int = 10  # Seconds between unanswered keepalive probes
+    DB_KEEPALIVES_COUNT: int = 3  # Unanswered probes before the connection is considered dead
+    DB_PING_IDLE_SEC: int = 30  # Connections idle longer than this are pinged before reuse
+    DB_PREPARE_THRESHOLD: int = 1  # Prior runs before a repeated agent query is prepared; 0 = on first run, -1 = never (also for the data dictionary lookups)
+    DB_PREPARED_MAX: int = 256  # Prepared statements kept per connection before they are all deallocated
+    DB_METADATA_WORK_MEM: str = "64MB"  # work_mem for the catalog reads behind get_complete_schema
 
     # LLM Configuration
     LLM_API_KEY: str
     LLM_MODEL: str = "gpt-4.1-mini"
     LLM_TEMPERATURE: float = 0.2
+    # OpenAI-compatible endpoint for a self-hosted model (e.g. vLLM started with --enable-prefix-caching,
+    # so the static system prompts are prefilled once and reused); unset uses the provider's API
+    LLM_BASE_URL: Optional[str] = None
 
     # Agent Configuration
     MAX_CONVERSATIONS: int = 40
+    LLM_MAX_CONCURRENCY: int = 8  # Cap on in-flight Stage 3 generation calls across all requests
+    CANDIDATE_TARGET_UNIQUE: int = 3  # Stop generating once this many distinct SQL candidates arrived
+    QUERY_MAX_ROWS: int = 200  # Rows returned by query_database; larger results are cut and flagged
+    QUERY_FETCH_SIZE: int = 1000  # Rows per round-trip when a server-side cursor streams a result
+    QUERY_BULK_MAX_ROWS: int = 100000  # Rows returned by query_database_bulk as CSV; larger results are cut and flagged
+    EXPLAIN_MAX_CONCURRENCY: int = 2  # explain_query calls allowed to hold pooled connections at once
+    EXPLAIN_STATEMENT_TIMEOUT_MS: int = 2000  # statement_timeout for explain_query
+    EXPLAIN_LOCK_TIMEOUT_MS: int = 500  # lock_timeout for explain_query
+    SCHEMA_LINKING_MODE: Literal["fused", "split"] = "fused"  # "fused": one SchemaColumnPicker chat; "split": SchemaAnalyst then ColumnSelector
+    FULL_TRACE: bool = False  # Return every agent turn in AgentResponse.conversation instead of per-stage summaries
 
     # API Configuration
     API_HOST: str = "0.0.0.0"
     API_PORT: int = 8000
     LOG_LEVEL: str = "info"
 
+    # Cache Configuration
+    SCHEMA_CACHE_TTL_SEC: int = 300  # How long schema and data dictionary lookups are served from memory
+    CANDIDATE_CACHE_TTL_SEC: int = 3600  # How long validated SQL candidates are reused for a repeated question
+
     # METADATA Configuration
     METADATA_AVAILABLE: bool 
     DD_TABLE_NAME_ONLY: str 
     DD_COLUMN_NAME_ONLY: str 
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        # Parse schemas from comma-separated string to list
-        if isinstance(self.DB_SCHEMAS, str):
-            self.DB_SCHEMAS = [schema.strip() for schema in self.DB_SCHEMAS.split(",")]
+    @field_validator("DB_SCHEMAS", mode="before")
+    @classmethod
+    def _split_schemas(cls, v):
+        # Accept either a JSON list or a comma-separated string from the environment
+        if isinstance(v, str):
+            if v.lstrip().startswith("["):
+                return json.loads(v)
+            return [schema.strip() for schema in v.split(",")]
+        return v
 
     class Config:
         env_file = ".env"
@@ -1,162 +1,343 @@
+import asyncio
+import functools
+import hashlib
 import json
 import logging
-from typing import List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed # Import as_completed
-import threading
+import orjson
+from collections import deque
+from pydantic import TypeAdapter
+from typing import List, Dict, Any, Tuple
 from api.models.schemas import MessageContent, AgentResponse
-from core.agents_sequential import AgentFactorySequential
+from core.agents_sequential import get_agent_pool
 from core.orchestration_tools import build_m_schema_string
+from prompts.agent_prompts_sequential import render_sql_generator_user
+from tools.cache import TTLCache
+from tools.db_tools import get_data_dictionary_tables, get_all_db_objects, query_database, query_prepared, match_prepared, json_default
+from tools.sql_guard import check
+from tools.sql_lint import lint
 from config.settings import get_settings
 import re # Already in your original file, good for the final selector
 
-# Import get_data_dictionary_tables if it exists in a module, e.g. core.schema_tools
-try:
-    from core.schema_tools import get_data_dictionary_tables, get_all_db_objects
-except ImportError:
-    # Define dummy functions or handle the import error as needed
-    def get_data_dictionary_tables():
-        raise NotImplementedError("get_data_dictionary_tables is not implemented or imported.")
-
-    def get_all_db_objects():
-        raise NotImplementedError("get_all_db_objects is not implemented or imported.")
-
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+# Stage 5 helpers, hoisted out of the request path.
+_LETTER_RE = re.compile(r'[A-Z]')
+_CANDIDATE_LABELS = [chr(65 + i) for i in range(26)]
+
+# Shared by every request so the provider sees at most LLM_MAX_CONCURRENCY generation calls.
+_LLM_SEMAPHORE = asyncio.Semaphore(settings.LLM_MAX_CONCURRENCY)
+
+# Validates the whole conversation in one pydantic-core call instead of one model per message.
+_MSG_LIST_ADAPTER = TypeAdapter(List[MessageContent])
+
+# Validated SQL candidates per (question, M-Schema), so repeated questions skip Stage 3.
+_CANDIDATE_CACHE = TTLCache(ttl_sec=settings.CANDIDATE_CACHE_TTL_SEC, maxsize=1024)
+
+
+def _candidate_cache_key(question: str, m_schema: str) -> str:
+    # The M-Schema embeds the schema itself, so DDL that changes it also changes the key
+    return hashlib.blake2b(f"{question}|{m_schema}".encode(), digest_size=16).hexdigest()
+
+
+def _all_table_names() -> List[str]:
+    """Returns every 'schema.table' name; get_all_db_objects serves this from its schema cache."""
+    db_objects = get_all_db_objects()
+    # Materialized views (e.g. the pre-joined sales_fact) are queryable like tables
+    return [f'{t["schema"]}.{t["name"]}' for t in db_objects["tables"] + db_objects.get("materialized_views", [])]
+
+
+@functools.lru_cache(maxsize=256)
+def _extract_json_from_string(text: str) -> str:
+    """
+    Finds and returns the first valid JSON object substring in a string.
+    Handles cases where the LLM might add leading/trailing text or newlines.
+    Memoized, since the same agent responses are routinely parsed more than once.
+    """
+    # Fast path: the whole response is already a JSON object
+    stripped = text.strip()
+    if stripped.startswith('{') and stripped.endswith('}'):
+        try:
+            orjson.loads(stripped)
+            return stripped
+        except orjson.JSONDecodeError:
+            pass
+
+    # Find the start of the first potential JSON object
+    start_brace = text.find('{')
+    if start_brace == -1:
+        return "{}" # No JSON object found
+
+    # Start from the first brace and try to decode a JSON object
+    potential_json = text[start_brace:]
+    decoder = json.JSONDecoder()
+    try:
+        # decode will find the first valid JSON object and stop
+        obj, end_index = decoder.raw_decode(potential_json)
+        # Return the substring that constitutes the valid JSON
+        return potential_json[:end_index]
+    except json.JSONDecodeError:
+        # If raw_decode fails, it means there's no valid JSON object starting from the first brace.
+        logger.warning(f"Could not find a valid JSON object in the text: {text}")
+        return "{}"
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_json_list_cached(content: str, key: str) -> tuple:
+    """
+    Extracts the non-empty list stored under `key` in the JSON object inside `content`.
+    Memoized on the raw response text, so repeated agent answers are parsed once.
+
+    Returns:
+        tuple: The list items (a tuple, so cached values can't be mutated by callers).
+
+    Raises:
+        ValueError: If the key is missing, not a list, or empty.
+    """
+    data = orjson.loads(_extract_json_from_string(content))
+    value = data.get(key, [])
+    # If value is not a list or is empty, trigger fallback
+    if not isinstance(value, list) or not value:
+        raise ValueError(f"Key '{key}' missing or empty in agent response.")
+    return tuple(value)
+
+
+def _link_store_state(tables: List[str], columns: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Adds the store_state lookup to a schema selection that includes sell_prices.
+
+    sell_prices has no state column; the SQLGenerator prompt requires filtering it by state
+    through store_state, and the generator may only use what the M-Schema lists.
+    """
+    table_names = {table.rpartition('.')[-1] for table in tables}
+    if "sell_prices" not in table_names or "store_state" in table_names:
+        return tables, columns
+    lookup = f"{settings.DB_SCHEMAS[0]}.store_state"
+    return tables + [lookup], columns + [f"{lookup}.store_id", f"{lookup}.state_id"]
+
+
+def _validation_failed(validation: Dict[str, Any]) -> bool:
+    """True if a validated candidate was rejected or did not run successfully."""
+    result = validation.get("result")
+    if validation.get("error") or not isinstance(result, list):
+        return True
+    # Validator chat failures carry the error inside the result list
+    return len(result) == 1 and isinstance(result[0], dict) and "error" in result[0]
+
+
+def _preview_result(result: Any, limit: int = 200) -> str:
+    """
+    Returns the first `limit` characters of the result as JSON without encoding all of it.
+
+    Validation results can hold thousands of rows; only as many rows as fit in the
+    preview are rendered.
+    """
+    if not isinstance(result, list):
+        return str(result)[:limit]
+    parts = []
+    length = 1
+    for row in result:
+        row_repr = orjson.dumps(row, default=json_default).decode()
+        parts.append(row_repr)
+        length += len(row_repr) + 2
+        if length > limit:
+            return ("[" + ", ".join(parts))[:limit]
+    return ("[" + ", ".join(parts) + "]")[:limit]
+
+
+def _hash_result(result: Any) -> bytes:
+    """Cheap, order-stable key for a result set; avoids str() on large lists of dicts."""
+    try:
+        return orjson.dumps(result, default=json_default, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return repr(result).encode()
+
+
 class AgentManagerSequential:
     def __init__(self, api_key: str = None, model: str = None, temperature: float = None):
         self.api_key = api_key or settings.LLM_API_KEY
         self.model = model or settings.LLM_MODEL
         self.temperature = temperature if temperature is not None else settings.LLM_TEMPERATURE
-        # Note: Threading might be overkill if FastAPI runs each request in its own thread, but it's safe.
-        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="agent_worker")
-        self._lock = threading.Lock()
+        # Resolved once here so the agent factory never has to fall back to settings itself
+        self._agent_kwargs = dict(api_key=self.api_key, model=self.model, temperature=self.temperature)
+        self._agent_pool = get_agent_pool(**self._agent_kwargs)
+        self._agent_pool.prewarm()
 
-    def process_query(self, query: str) -> AgentResponse:
+    async def process_query(self, query: str) -> AgentResponse:
         logger.info(f"AgentManager.process_query received query: '{query}'")
-        with self._lock:
-            result = self._orchestrate_workflow(query)
+        # Every stage is LLM I/O, so the workflow runs on the event loop and
+        # concurrent requests simply interleave instead of queueing on a worker thread.
+        result = await self._orchestrate_workflow(query)
         logger.info(f"AgentManager.process_query finished for query: '{query}'")
         return result
 
-    def _orchestrate_workflow(self, query: str) -> AgentResponse:
+    async def _orchestrate_workflow(self, query: str) -> AgentResponse:
         logger.info("--- XIYAN-SQL ORCHESTRATED WORKFLOW START ---")
-        full_conversation_history = []
-        
+        # Only ever appended to, then walked once when building the response
+        full_conversation_history = deque()
+        # Check out a reusable toolkit of agents (histories are reset on checkout)
+        agents = self._agent_pool.acquire()
+
         try:
-            # Create our toolkit of agents
-            agents = AgentFactorySequential.create_agents(
-                api_key=self.api_key, model=self.model, temperature=self.temperature
-            )
-            print("created new sequential agents")
-            user_proxy = agents.pop("UserProxy")
+            user_proxy = agents["UserProxy"]
 
             # === STAGE 1: SCHEMA LINKING ===
-            logger.info("[Orchestrator] STAGE 1: Schema Linking")
-            schema_analyst = agents["SchemaAnalyst"]
+            logger.info(f"[Orchestrator] STAGE 1: Schema Linking ({settings.SCHEMA_LINKING_MODE})")
             task_1_prompt = f"User Question: '{query}'"
-            chat_res_1 = user_proxy.initiate_chat(schema_analyst, message=task_1_prompt, clear_history=True, max_turns=3)
-            full_conversation_history.extend(chat_res_1.chat_history)
+            if settings.SCHEMA_LINKING_MODE == "split":
+                schema_analyst = agents["SchemaAnalyst"]
+                chat_res_1 = await user_proxy.a_initiate_chat(schema_analyst, message=task_1_prompt, clear_history=True, max_turns=3)
+                full_conversation_history.extend(self._summarize_stage(chat_res_1.chat_history, "Schema Linking"))
+            else:
+                # One chat answers both tables and columns, saving a full LLM round-trip
+                schema_column_picker = agents["SchemaColumnPicker"]
+                chat_res_1 = await user_proxy.a_initiate_chat(schema_column_picker, message=task_1_prompt, clear_history=True, max_turns=5)
+                full_conversation_history.extend(self._summarize_stage(chat_res_1.chat_history, "Schema Linking"))
             try:
                 selected_tables = self._parse_json_list(chat_res_1, 'tables')
             except ValueError:
                 logger.warning("Falling back to all tables from get_all_db_objects due to missing 'tables' key.")
-                selected_tables = [f'{t["schema"]}.{t["name"]}' for t in get_all_db_objects()["tables"]]            
+                selected_tables = await asyncio.to_thread(_all_table_names)
                 logger.info(f"[Orchestrator] Selected Tables: {selected_tables}")
 
-            column_selector = agents["ColumnSelector"]
-            task_2_prompt = f"Relevant Tables: {selected_tables}\nUser Question: '{query}'"
-            chat_res_2 = user_proxy.initiate_chat(column_selector, message=task_2_prompt, clear_history=True, max_turns=5)
-            full_conversation_history.extend(chat_res_2.chat_history)
-            selected_columns = self._parse_json_list(chat_res_2, 'columns')
+            if settings.SCHEMA_LINKING_MODE == "split":
+                column_selector = agents["ColumnSelector"]
+                task_2_prompt = f"Relevant Tables: {selected_tables}\nUser Question: '{query}'"
+                chat_res_2 = await user_proxy.a_initiate_chat(column_selector, message=task_2_prompt, clear_history=True, max_turns=5)
+                full_conversation_history.extend(self._summarize_stage(chat_res_2.chat_history, "Column Selection"))
+                selected_columns = self._parse_json_list(chat_res_2, 'columns')
+            else:
+                selected_columns = self._parse_json_list(chat_res_1, 'columns')
             logger.info(f"[Orchestrator] Selected Columns: {selected_columns}")
 
             # === STAGE 2: M-SCHEMA CONSTRUCTION ===
             logger.info("[Orchestrator] STAGE 2: M-Schema Construction")
-            m_schema = build_m_schema_string(tables=selected_tables, columns=selected_columns)
+            selected_tables, selected_columns = _link_store_state(selected_tables, selected_columns)
+            m_schema = await build_m_schema_string(tables=selected_tables, columns=selected_columns)
             logger.info(f"[Orchestrator] Constructed M-Schema:\n{m_schema}")
             full_conversation_history.append({"role": "system", "name": "Orchestrator", "content": f"M-Schema constructed:\n{m_schema}"})
 
-            # === STAGE 3: CANDIDATE GENERATION (MODIFIED FOR PARALLELISM) ===
-            logger.info("[Orchestrator] STAGE 3: Candidate Generation (Parallel)")
+            # === STAGES 3 & 4: CANDIDATE GENERATION PIPELINED INTO VALIDATION ===
+            # Validation is the slowest step, so each candidate is handed to its own validator
+            # the moment it is generated instead of waiting for the whole batch.
+            logger.info("[Orchestrator] STAGE 3: Candidate Generation (Parallel, pipelined into Stage 4)")
             sql_generator = agents["SQLGenerator"]
             candidate_queries = []
             temperatures_to_try = [0.0, 0.2, 0.4, 0.6, 0.8]  
 
-            generation_prompt = f"""
-            User Question: '{query}'
-
-            M-Schema:
-            {m_schema}
-            """
-            
-            # Use a ThreadPoolExecutor to run generation in parallel
-            with ThreadPoolExecutor(max_workers=len(temperatures_to_try)) as executor:
-                # Store futures to retrieve results later
-                future_to_temp = {
-                    executor.submit(self._generate_single_candidate, sql_generator, generation_prompt, temp): temp
-                    for temp in temperatures_to_try
-                }
-
-                for future in as_completed(future_to_temp):
-                    temp = future_to_temp[future]
+            generation_prompt = render_sql_generator_user(query, m_schema)
+
+            # Every concurrent validation chat gets its own validator so histories can't interleave.
+            sql_validators = iter(self._agent_pool.sql_validators(agents, len(temperatures_to_try)))
+            candidate_cache_key = _candidate_cache_key(query, m_schema)
+            cached_candidates = _CANDIDATE_CACHE.get(candidate_cache_key)
+            if cached_candidates:
+                # Same question over the same M-Schema: re-run the previously validated SQL instead of regenerating it
+                logger.info(f"Reusing {len(cached_candidates)} cached candidates. Skipping generation.")
+                full_conversation_history.append({"role": "system", "name": "Orchestrator", "content": f"Reused {len(cached_candidates)} previously validated candidates"})
+                candidate_queries = list(cached_candidates)
+                validation_tasks = [
+                    asyncio.create_task(self._validate_one(user_proxy, next(sql_validators), sql_candidate))
+                    for sql_candidate in candidate_queries
+                ]
+            else:
+                async def generate(temp: float):
                     try:
-                        sql_candidate = future.result()
-                        if sql_candidate:
+                        async with _LLM_SEMAPHORE:
+                            return temp, await self._generate_single_candidate(sql_generator, generation_prompt, temp)
+                    except Exception as exc:
+                        logger.error(f"Candidate generation with temperature {temp} failed: {exc}", exc_info=True)
+                        return temp, ""
+
+                validation_tasks = []
+                unique_sqls = set()
+                remaining_temperatures = iter(temperatures_to_try)
+                generation_tasks = set()
+
+                def submit_generations():
+                    # Low-variance runs mostly repeat themselves, so only ask for as many candidates as are
+                    # still missing; a call in flight can't be stopped once it has reached the provider.
+                    while len(generation_tasks) + len(unique_sqls) < settings.CANDIDATE_TARGET_UNIQUE:
+                        temp = next(remaining_temperatures, None)
+                        if temp is None:
+                            return
+                        generation_tasks.add(asyncio.create_task(generate(temp)))
+
+                submit_generations()
+                while generation_tasks:
+                    finished, _ = await asyncio.wait(generation_tasks, return_when=asyncio.FIRST_COMPLETED)
+                    generation_tasks.difference_update(finished)
+                    for finished_task in finished:
+                        temp, sql_candidate = finished_task.result()
+                        normalized_sql = " ".join(sql_candidate.split()).lower()
+                        if sql_candidate and normalized_sql in unique_sqls:
+                            logger.info(f"Candidate with temperature {temp} duplicates an earlier one. Skipping validation.")
+                        elif sql_candidate:
+                            unique_sqls.add(normalized_sql)
                             logger.info(f"Successfully generated candidate with temperature {temp}.")
                             candidate_queries.append(sql_candidate)
                             # Log interaction for debugging
                             full_conversation_history.append({"role": "system", "name": "Orchestrator", "content": f"Generated candidate with temp {temp}"})
                             full_conversation_history.append({"role": "user", "content": generation_prompt})
                             full_conversation_history.append({"role": "assistant", "name": "SQLGenerator", "content": sql_candidate})
+                            validation_tasks.append(asyncio.create_task(
+                                self._validate_one(user_proxy, next(sql_validators), sql_candidate)
+                            ))
                         else:
                             logger.warning(f"SQLGenerator produced an empty response for temperature {temp}.")
-                    except Exception as exc:
-                        logger.error(f"Candidate generation with temperature {temp} failed: {exc}", exc_info=True)
+                    submit_generations()
 
             logger.info(f"[Orchestrator] Final Generated Candidates: {candidate_queries}")
             if not candidate_queries:
                 raise ValueError("SQLGenerator failed to produce any valid candidates. Halting workflow.")
 
-            # === STAGE 4: VALIDATION & REFINEMENT ===
-            # (This section remains unchanged from your original code)
-            logger.info("[Orchestrator] STAGE 4: Validation & Refinement")
-            sql_validator = agents["SQLValidator"]
+            # === STAGE 4: VALIDATION & REFINEMENT (PARALLEL) ===
+            logger.info("[Orchestrator] STAGE 4: Waiting for in-flight validations")
             validated_results = []
-            for i, sql in enumerate(candidate_queries):
-                task_4_prompt = f"Validate, refine if necessary, and execute this query:\n```sql\n{sql}\n```"
-                chat_res_4 = user_proxy.initiate_chat(sql_validator, message=task_4_prompt, clear_history=True)
-                full_conversation_history.extend(chat_res_4.chat_history)
-                last_response = chat_res_4.summary
-                try:
-                    validation_dict = json.loads(self._extract_json_from_string(last_response))
-                except (json.JSONDecodeError, TypeError):
-                    validation_dict = {"final_query": sql, "result": [{"error": "Failed to parse validator's JSON response."}]}
+            for validation_dict, validation_history in await asyncio.gather(*validation_tasks):
+                full_conversation_history.extend(self._summarize_stage(validation_history, "Validation"))
                 validated_results.append(validation_dict)
             logger.info(f"[Orchestrator] Validated Results: {validated_results}")
+            if not cached_candidates:
+                reusable = tuple(
+                    res["final_query"] for res in validated_results
+                    if res.get("final_query") and not _validation_failed(res)
+                )
+                if reusable:
+                    _CANDIDATE_CACHE.set(candidate_cache_key, reusable)
 
             # 🚨 Remove duplicate responses before final selection
-            validated_results = self.deduplicate_responses(validated_results)
-            if self.has_duplicate_responses(validated_results):
-                print("🛑 Detected repeated output (loop) after deduplication!")
+            validated_results, had_duplicates = self._dedupe_and_flag(validated_results)
+            if had_duplicates:
+                logger.debug("🛑 Detected repeated output (loop)!")
+
+            # Rejected and failed candidates can't be the answer; only if every candidate failed are they all shown
+            succeeded = [res for res in validated_results if not _validation_failed(res)]
+            if succeeded:
+                if len(succeeded) < len(validated_results):
+                    logger.info(f"Dropped {len(validated_results) - len(succeeded)} failed candidates before final selection.")
+                validated_results = succeeded
+            else:
+                logger.warning("Every candidate failed validation; passing them all to final selection.")
 
             # === STAGE 5: FINAL SELECTION ===
             # (This section remains unchanged from your original code)
             logger.info("[Orchestrator] STAGE 5: Final Selection")
             final_selector = agents["FinalSelector"]
-            selection_prompt = f"Original Question: '{query}'\n\n"
+            selection_parts = [f"Original Question: '{query}'\n\n"]
             for i, res in enumerate(validated_results):
-                result_preview = str(res.get('result', 'No result'))[:200]
-                selection_prompt += f"--- Candidate {chr(65+i)} ---\nSQL: {res.get('final_query', 'No query')}\nResult Preview: {result_preview}...\n\n"
-            selection_prompt += "Which candidate is the best answer? Respond with ONLY the single character of your choice (e.g., A, B, or C)."
+                result_preview = _preview_result(res.get('result', 'No result'))
+                selection_parts.append(f"--- Candidate {_CANDIDATE_LABELS[i]} ---\nSQL: {res.get('final_query', 'No query')}\nResult Preview: {result_preview}...\n\n")
+            selection_parts.append("Which candidate is the best answer? Respond with ONLY the single character of your choice (e.g., A, B, or C).")
+            selection_prompt = "".join(selection_parts)
             
-            chat_res_5 = user_proxy.initiate_chat(final_selector, message=selection_prompt, clear_history=True, max_turns=1)
-            full_conversation_history.extend(chat_res_5.chat_history)
+            chat_res_5 = await user_proxy.a_initiate_chat(final_selector, message=selection_prompt, clear_history=True, max_turns=1)
+            full_conversation_history.extend(self._summarize_stage(chat_res_5.chat_history, "Final Selection"))
 
             final_choice_letter = ""
             summary_text = chat_res_5.summary.upper().strip()
 
-            match = re.search(r'[A-Z]', summary_text)
+            match = _LETTER_RE.search(summary_text)
             if match:
                 final_choice_letter = match.group(0)
             else:
@@ -169,36 +350,42 @@ class AgentManagerSequential:
                 final_answer_index = 0
 
             final_answer_obj = validated_results[final_answer_index]
-            final_answer_str = json.dumps(final_answer_obj, indent=2)
+            # Directly executed candidates carry raw database values (e.g. Decimal)
+            final_answer_str = orjson.dumps(final_answer_obj, default=json_default, option=orjson.OPT_INDENT_2).decode()
             logger.info(f"[Orchestrator] Final Choice: {final_choice_letter}. Final Answer: {final_answer_str}")
 
+            # Filtering materializes the deque into the list the adapter validates
+            filtered_history = [msg for msg in full_conversation_history if msg.get("role") and msg.get("content")]
             return AgentResponse(
-                conversation=[MessageContent(**msg) for msg in full_conversation_history if msg.get("role") and msg.get("content")],
+                conversation=_MSG_LIST_ADAPTER.validate_python(filtered_history),
                 final_answer=final_answer_str
             )
         except Exception as e:
             logger.error(f"Error in orchestration workflow: {e}", exc_info=True)
             return AgentResponse(conversation=[], final_answer=f"An error occurred: {e}")
+        finally:
+            self._agent_pool.release(agents)
 
     # Helper function for parallel execution
-    def _generate_single_candidate(self, agent: Any, prompt: str, temperature: float) -> str:
-        """Generates a single SQL candidate query in a thread-safe way."""
-        
-        # Create a temporary config to avoid race conditions on the agent's main llm_config
-        temp_llm_config = agent.llm_config.copy()
-        temp_llm_config['temperature'] = temperature
-
-        # Use the more direct generate_reply with the temporary config
-        response_message = agent.generate_reply(
-            messages=[{"role": "user", "content": prompt}],
-            config=temp_llm_config # Pass the temporary config here
+    async def _generate_single_candidate(self, agent: Any, prompt: str, temperature: float) -> str:
+        """
+        Generates a single SQL candidate query without touching shared agent state.
+
+        Calls the agent's own LLM client directly: a_generate_reply has no way to pass a
+        temperature, and every concurrent call shares the client's HTTP connection pool.
+        """
+        messages = [{"role": "system", "content": agent.system_message}, {"role": "user", "content": prompt}]
+        response = await asyncio.to_thread(
+            agent.client.create, messages=messages, temperature=temperature, cache=agent.client_cache
         )
+        response_message = agent.client.extract_text_or_completion_object(response)[0]
         
         sql_candidate = ""
-        if response_message and isinstance(response_message, dict):
-            sql_candidate = response_message.get("content", "").strip()
-        elif response_message and isinstance(response_message, str):
+        if isinstance(response_message, str):
             sql_candidate = response_message.strip()
+        elif response_message is not None:
+            # A completion message object, returned e.g. when the model attempted a tool call
+            sql_candidate = (response_message.content or "").strip()
 
         # Clean up potential markdown code blocks
         if sql_candidate.startswith("```sql"):
@@ -208,88 +395,131 @@ class AgentManagerSequential:
         
         return sql_candidate.strip()
 
-    def _extract_json_from_string(self, text: str) -> str:
+    async def _validate_one(self, user_proxy: Any, sql_validator: Any, sql: str) -> Tuple[dict, list]:
         """
-    Finds and returns the first valid JSON object substring in a string.
-    Handles cases where the LLM might add leading/trailing text or newlines.
-    """
-    # Find the start of the first potential JSON object
-        start_brace = text.find('{')
-        if start_brace == -1:
-            return "{}" # No JSON object found
+        Validates and executes one candidate.
+
+        Trivial typos are fixed locally by tools.sql_lint, queries breaking a tools.sql_guard
+        rule are rejected without running them, a per-state price aggregate is answered by its
+        prepared statement, and the rest is executed directly; only a query that still fails
+        goes through its own SQLValidator chat.
+
+        Returns:
+            The parsed validation envelope and the chat history to log.
+        """
+        sql, fixes = lint(sql)
+        if fixes:
+            logger.info(f"Applied local SQL fixes: {fixes}")
+        violation = check(sql)
+        if violation:
+            logger.info(f"Rejected candidate without executing it: {violation}")
+            return {"final_query": sql, "result": None, "error": violation}, []
+        prepared = match_prepared(sql)
+        if prepared:
+            name, params, column = prepared
+            result = await asyncio.to_thread(query_prepared, name, params)
+            if not (len(result) == 1 and "error" in result[0]):
+                # The same single value the query returns, under the column name it would have produced
+                rows = [{column: value} for row in result for value in row.values()]
+                return {"final_query": sql, "result": rows, "error": None}, []
+        result = await asyncio.to_thread(query_database, sql)
+        if not (len(result) == 1 and "error" in result[0]):
+            return {"final_query": sql, "result": result, "error": None}, []
+        logger.info(f"Candidate failed to execute, handing it to the SQLValidator: {result[0]['error']}")
 
-        # Start from the first brace and try to decode a JSON object
-        potential_json = text[start_brace:]
-        decoder = json.JSONDecoder()
         try:
-            # decode will find the first valid JSON object and stop
-            obj, end_index = decoder.raw_decode(potential_json)
-            # Return the substring that constitutes the valid JSON
-            return potential_json[:end_index]
-        except json.JSONDecodeError:
-            # If raw_decode fails, it means there's no valid JSON object starting from the first brace.
-            logger.warning(f"Could not find a valid JSON object in the text: {text}")
-            return "{}"
+            chat_res_4 = await user_proxy.a_initiate_chat(
+                sql_validator,
+                message=f"Validate, refine if necessary, and execute this query:\n```sql\n{sql}\n```",
+                clear_history=True,
+            )
+        except Exception as exc:
+            logger.error(f"Validation of candidate failed: {exc}", exc_info=True)
+            return {"final_query": sql, "result": [{"error": f"Validation failed: {exc}"}]}, []
+
+        try:
+            validation_dict = orjson.loads(_extract_json_from_string(chat_res_4.summary))
+        except (orjson.JSONDecodeError, TypeError):
+            validation_dict = {"final_query": sql, "result": [{"error": "Failed to parse validator's JSON response."}]}
+        return validation_dict, chat_res_4.chat_history
+
+    def _summarize_stage(self, chat_history: List[Dict[str, Any]], stage_name: str) -> List[Dict[str, Any]]:
+        """
+        Condenses one stage's chat for the API response.
+
+        Keeps system messages, the opening prompt and the final reply, plus a synthetic
+        Orchestrator note with the turn count. With settings.FULL_TRACE every turn is kept.
+
+        Args:
+            chat_history (List[Dict[str, Any]]): The messages of a single stage chat.
+            stage_name (str): Label used in the synthetic summary message.
+
+        Returns:
+            List[Dict[str, Any]]: The messages to append to the conversation history.
+        """
+        if settings.FULL_TRACE or not chat_history:
+            return list(chat_history)
+
+        with_content = [msg for msg in chat_history if msg.get("content")]
+        if not with_content:
+            return []
+        kept = [msg for msg in with_content if msg.get("role") == "system"]
+        first, last = with_content[0], with_content[-1]
+        if first not in kept:
+            kept.append(first)
+        if last is not first:
+            kept.append(last)
+        kept.append({
+            "role": "system",
+            "name": "Orchestrator",
+            "content": f"[{stage_name}] {len(chat_history)} turns, final: {str(last['content'])[:200]}",
+        })
+        return kept
 
     def _parse_json_list(self, chat_result: Any, key: str) -> List[str]:
         """Parses a JSON list from the last message of a chat result."""
+        last_message = None
         try:
             last_message = chat_result.chat_history[-1]['content']
-            json_str = self._extract_json_from_string(last_message)
-            data = json.loads(json_str)
-            value = data.get(key, [])
-            # If value is not a list or is empty, trigger fallback
-            if not isinstance(value, list) or not value:
-                raise ValueError(f"Key '{key}' missing or empty in agent response.")
-            return value
-        except (json.JSONDecodeError, KeyError, IndexError, AttributeError, ValueError) as e:
+            return list(_parse_json_list_cached(last_message, key))
+        except (orjson.JSONDecodeError, KeyError, IndexError, AttributeError, ValueError) as e:
             logger.error(f"Failed to parse JSON list with key '{key}': {e}. Content was: '{last_message}'")
             raise ValueError(f"Orchestrator could not parse a required response for key: {key}")
 
-    def close(self):
-        logger.info("Shutting down AgentManager executor.")
-        if hasattr(self, '_executor') and self._executor:
-            self._executor.shutdown(wait=True)
-
-    def has_duplicate_results(results):
+    def has_duplicate_results(self, results):
         """
         Returns True if there are duplicate rows in the results list.
         """
         seen = set()
         for row in results:
-            row_tuple = tuple(sorted(row.items()))
-            if row_tuple in seen:
+            try:
+                row_key = frozenset(row.items())
+            except TypeError:
+                # Nested values (lists/dicts) are unhashable; compare their repr instead
+                row_key = frozenset((k, repr(v)) for k, v in row.items())
+            if row_key in seen:
                 return True
-            seen.add(row_tuple)
+            seen.add(row_key)
         return False
 
-    def has_duplicate_responses(self, responses):
-        """
-        Returns True if there are duplicate SQL/result pairs in the responses list.
+    def _dedupe_and_flag(self, responses):
         """
-        seen = set()
-        for resp in responses:
-            key = (resp.get('final_query'), str(resp.get('result')))
-            if key in seen:
-                print("🛑 Detected repeated output (loop)!")
-                return True
-            seen.add(key)
-        return False
+        Remove duplicate responses based on their SQL and result in a single pass.
 
-    def deduplicate_responses(self, responses):
-        """
-        Remove duplicate responses based on their SQL and result.
+        Returns:
+            Tuple[List[dict], bool]: The unique responses (first occurrence wins) and
+            whether any duplicate was seen.
         """
-        seen = set()
-        unique_responses = []
+        seen = {}
+        had_duplicates = False
         for resp in responses:
-            key = (resp.get('final_query'), str(resp.get('result')))
-            if key not in seen:
-                unique_responses.append(resp)
-                seen.add(key)
+            key = (resp.get('final_query'), _hash_result(resp.get('result')))
+            if key in seen:
+                had_duplicates = True
+                logger.debug("🛑 Duplicate response removed from output log!")
             else:
-                print("🛑 Duplicate response removed from output log!")
-        return unique_responses
+                seen[key] = resp
+        return list(seen.values()), had_duplicates
 
     def get_data_dictionary_tables(self):
         """
@@ -300,7 +530,7 @@ class AgentManagerSequential:
             # ...process tables as usual...
         except Exception:
             # Fallback: use all tables from get_all_db_objects
-            tables = [f'{t["schema"]}.{t["name"]}' for t in get_all_db_objects()["tables"]]
+            tables = _all_table_names()
             # Always return the required format
             return {"tables": tables}
 
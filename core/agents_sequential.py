@@ -1,67 +1,107 @@
-from typing import Dict
+from typing import Dict, List, Union
+import asyncio
+import functools
 import logging
+import threading
 from autogen import ConversableAgent
 from config.settings import get_settings
-from tools.db_tools import query_database, explain_query, get_data_dictionary_tables, get_data_dictionary_columns,get_all_db_objects, get_complete_schema
+from tools.db_tools import dumps_result, query_database, query_database_batch, explain_query, get_data_dictionary_tables, get_data_dictionary_columns,get_all_db_objects, get_complete_schema_compact, get_schema_bundle
 from prompts.agent_prompts_sequential import (
     SCHEMA_ANALYST_PROMPT,
     COLUMN_SELECTOR_PROMPT,
-    SQL_GENERATOR_PROMPT,
+    SCHEMA_COLUMN_PICKER_PROMPT,
+    SQL_GENERATOR_SYSTEM,
     SQL_VALIDATOR_PROMPT,
     FINAL_SELECTOR_PROMPT,
+    get_prompt_tokens,
 )
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+
+def _offload(func):
+    """
+    Wraps a blocking database tool in a coroutine that runs it on a worker thread.
+
+    Autogen awaits coroutine tools but calls plain functions inline, which would block the
+    event loop (and every concurrent query) for the duration of the database round-trip.
+    The result is returned as JSON already: autogen would otherwise run it through
+    json.dumps, which is slow on large row lists and fails on NUMERIC (Decimal) values.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return dumps_result(await asyncio.to_thread(func, *args, **kwargs))
+    return wrapper
+
+
+def _system_message(prompt: str, llm_config: Dict) -> Union[str, List[Dict]]:
+    """
+    Returns the agent's static system prompt, marked as a prompt-cache breakpoint for Anthropic.
+
+    The prompts carry no per-request data, so every call shares this prefix. Anthropic only
+    caches it when asked to via `cache_control`; OpenAI caches stable prefixes on its own and
+    rejects the extra field, so other providers get the plain string.
+    """
+    if llm_config["config_list"][0].get("api_type") == "anthropic":
+        return [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+    return prompt
+
+
 class AgentFactorySequential:
     """Factory class for creating a toolkit of specialized agents."""
 
     @staticmethod
-    def create_agents(api_key: str = None, model: str = None, temperature: float = None) -> Dict[str, ConversableAgent]:
+    def create_agents(api_key: str, model: str, temperature: float) -> Dict[str, ConversableAgent]:
         """
         Creates and configures all specialized agents for the XiYan-SQL pipeline.
 
         Returns:
             dict: A dictionary of configured ConversableAgent instances.
         """
-        api_key = api_key or settings.LLM_API_KEY
-        model = model or settings.LLM_MODEL
-        temperature = temperature if temperature is not None else settings.LLM_TEMPERATURE
-
-        llm_config = {"config_list": [{"model": model, "api_key": api_key}], "temperature": temperature}
+        llm_config = AgentFactorySequential._build_llm_config(api_key, model, temperature)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Provider prefix caches only kick in above a minimum prompt length (1024 tokens for OpenAI)
+            for prompt_name in ("SCHEMA_ANALYST_PROMPT", "COLUMN_SELECTOR_PROMPT", "SCHEMA_COLUMN_PICKER_PROMPT", "SQL_GENERATOR_SYSTEM", "SQL_VALIDATOR_PROMPT", "FINAL_SELECTOR_PROMPT"):
+                tokens = get_prompt_tokens(prompt_name)
+                if tokens is not None:
+                    logger.debug(f"{prompt_name}: {len(tokens)} static prompt tokens")
 
         # --- STAGE 1 AGENTS ---
-        schema_analyst = ConversableAgent(
-            name="SchemaAnalyst",
-            system_message=SCHEMA_ANALYST_PROMPT,
-            llm_config=llm_config.copy(),
-        )
-
-        column_selector = ConversableAgent(
-            name="ColumnSelector",
-            system_message=COLUMN_SELECTOR_PROMPT,
-            llm_config=llm_config.copy(),
-        )
+        # Only the agents of the configured schema linking mode are built
+        if settings.SCHEMA_LINKING_MODE == "split":
+            table_pickers = [ConversableAgent(
+                name="SchemaAnalyst",
+                system_message=_system_message(SCHEMA_ANALYST_PROMPT, llm_config),
+                llm_config=llm_config.copy(),
+            )]
+            column_pickers = [ConversableAgent(
+                name="ColumnSelector",
+                system_message=_system_message(COLUMN_SELECTOR_PROMPT, llm_config),
+                llm_config=llm_config.copy(),
+            )]
+        else:
+            table_pickers = column_pickers = [ConversableAgent(
+                name="SchemaColumnPicker",
+                system_message=_system_message(SCHEMA_COLUMN_PICKER_PROMPT, llm_config),
+                llm_config=llm_config.copy(),
+            )]
 
         # --- STAGE 3 AGENT ---
+        # Stage 3 picks a temperature per call; autogen would let a configured one override it
         sql_generator = ConversableAgent(
             name="SQLGenerator",
-            system_message=SQL_GENERATOR_PROMPT,
-            llm_config=llm_config.copy(),
+            system_message=_system_message(SQL_GENERATOR_SYSTEM, llm_config),
+            llm_config={key: value for key, value in llm_config.items() if key != "temperature"},
         )
 
         # --- STAGE 4 AGENT ---
-        sql_validator = ConversableAgent(
-            name="SQLValidator",
-            system_message=SQL_VALIDATOR_PROMPT,
-            llm_config=llm_config.copy(),
-        )
+        sql_validator = AgentFactorySequential.create_sql_validator(api_key, model, temperature)
 
         # --- STAGE 5 AGENT ---
         final_selector = ConversableAgent(
             name="FinalSelector",
-            system_message=FINAL_SELECTOR_PROMPT,
+            system_message=_system_message(FINAL_SELECTOR_PROMPT, llm_config),
             llm_config=llm_config.copy(),
         )
         
@@ -78,32 +118,155 @@ class AgentFactorySequential:
 
         # --- TOOL REGISTRATION ---
         # Register tools for the agents that need them
-        schema_analyst.register_for_llm(name="get_all_db_objects", description="Get a raw list of all tables, views, and materialized views from the database.")(get_all_db_objects)
-        user_proxy.register_for_execution(name="get_all_db_objects")(get_all_db_objects)
+        for table_picker in table_pickers:
+            table_picker.register_for_llm(name="get_all_db_objects", description="Get a raw list of all tables, views, and materialized views from the database.")(get_all_db_objects)
+        user_proxy.register_for_execution(name="get_all_db_objects")(_offload(get_all_db_objects))
         
-        column_selector.register_for_llm(name="get_complete_schema", description="Get the complete technical schema (columns, types, keys) for all tables.")(get_complete_schema)
-        user_proxy.register_for_execution(name="get_complete_schema")(get_complete_schema)
+        # Served in the columnar layout, which serializes to far fewer tokens than one dict per column
+        for column_picker in column_pickers:
+            column_picker.register_for_llm(
+                name="get_complete_schema",
+                description="Get the complete technical schema for all tables: per table, parallel 'columns'/'types'/'nullable' lists, plus 'defaults', 'max_length' and 'foreign_keys' maps where present.",
+            )(get_complete_schema_compact)
+        user_proxy.register_for_execution(name="get_complete_schema")(_offload(get_complete_schema_compact))
+
+        for column_picker in column_pickers:
+            column_picker.register_for_llm(
+                name="get_schema_bundle",
+                description="Get the complete technical schema for all tables with the data dictionary's table and column descriptions merged in, in one call.",
+            )(get_schema_bundle)
+        user_proxy.register_for_execution(name="get_schema_bundle")(_offload(get_schema_bundle))
 
         # Register the preferred data dictionary tools ONLY if they are available
         if settings.METADATA_AVAILABLE:
             logger.info("METADATA_AVAILABLE is True. Registering data dictionary tools.")
-            schema_analyst.register_for_llm(name="get_data_dictionary_tables", description="Get descriptions of all available data tables.")(get_data_dictionary_tables)
-            user_proxy.register_for_execution(name="get_data_dictionary_tables")(get_data_dictionary_tables)
+            for table_picker in table_pickers:
+                table_picker.register_for_llm(name="get_data_dictionary_tables", description="Get descriptions of all available data tables.")(get_data_dictionary_tables)
+            user_proxy.register_for_execution(name="get_data_dictionary_tables")(_offload(get_data_dictionary_tables))
             
-            column_selector.register_for_llm(name="get_data_dictionary_columns", description="Get detailed column descriptions for a list of tables.")(get_data_dictionary_columns)
-            user_proxy.register_for_execution(name="get_data_dictionary_columns")(get_data_dictionary_columns)
+            for column_picker in column_pickers:
+                column_picker.register_for_llm(name="get_data_dictionary_columns", description="Get detailed column descriptions for a list of tables.")(get_data_dictionary_columns)
+            user_proxy.register_for_execution(name="get_data_dictionary_columns")(_offload(get_data_dictionary_columns))
         else:
             logger.info("METADATA_AVAILABLE is False. Skipping registration of data dictionary tools.")
 
         # The validator needs to execute SQL, which is always available
-        sql_validator.register_for_llm(name="query_database", description="Execute a SQL query and get results.")(query_database)
-        user_proxy.register_for_execution(name="query_database")(query_database)
+        user_proxy.register_for_execution(name="query_database")(_offload(query_database))
+        user_proxy.register_for_execution(name="query_database_batch")(_offload(query_database_batch))
 
         return {
-            "SchemaAnalyst": schema_analyst,
-            "ColumnSelector": column_selector,
+            **{agent.name: agent for agent in table_pickers + column_pickers},
             "SQLGenerator": sql_generator,
             "SQLValidator": sql_validator,
             "FinalSelector": final_selector,
             "UserProxy": user_proxy, # The proxy is needed to trigger tool execution
         }
+
+    @staticmethod
+    def create_sql_validator(api_key: str, model: str, temperature: float) -> ConversableAgent:
+        """
+        Creates a standalone SQLValidator with the query_database tools exposed to its LLM.
+
+        Stage 4 validates candidates concurrently, and each concurrent chat needs its own
+        validator instance so the conversations don't share history. Execution of the tool
+        stays with the UserProxy returned by create_agents.
+
+        Returns:
+            ConversableAgent: A configured SQLValidator agent.
+        """
+        llm_config = AgentFactorySequential._build_llm_config(api_key, model, temperature)
+        sql_validator = ConversableAgent(
+            name="SQLValidator",
+            system_message=_system_message(SQL_VALIDATOR_PROMPT, llm_config),
+            llm_config=llm_config,
+        )
+        sql_validator.register_for_llm(name="query_database", description="Execute a SQL query and get results.")(query_database)
+        sql_validator.register_for_llm(
+            name="query_database_batch",
+            description="Execute several SQL queries on one database connection; a failing query does not abort the others.",
+        )(query_database_batch)
+        return sql_validator
+
+    @staticmethod
+    def _build_llm_config(api_key: str, model: str, temperature: float) -> Dict:
+        # Defaults are resolved once by AgentManagerSequential, so the values arrive ready to use
+        model_config = {"model": model, "api_key": api_key}
+        if settings.LLM_BASE_URL:
+            model_config["base_url"] = settings.LLM_BASE_URL
+        elif model.startswith("claude"):
+            # Routes the calls through autogen's Anthropic client; a configured base_url is an
+            # OpenAI-compatible endpoint, which keeps the default client whatever the model name
+            model_config["api_type"] = "anthropic"
+        return {"config_list": [model_config], "temperature": temperature}
+
+
+class AgentPool:
+    """
+    Keeps finished agent sets around so they can be reused by later queries.
+
+    Building a set means instantiating six ConversableAgents and wrapping every tool, which is
+    pure overhead when the configuration hasn't changed. A set is only ever used by one query at
+    a time: concurrent queries each check out their own set, and every agent is reset on checkout
+    so no chat history leaks between queries.
+    """
+
+    def __init__(self, api_key: str, model: str, temperature: float):
+        self._factory_kwargs = {"api_key": api_key, "model": model, "temperature": temperature}
+        self._idle: List[Dict[str, ConversableAgent]] = []
+        # Extra SQLValidators created for concurrent Stage 4 chats, kept with the set they belong to
+        self._extra_validators: Dict[int, List[ConversableAgent]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Dict[str, ConversableAgent]:
+        """
+        Check out an agent set, building a new one if none is idle.
+
+        Returns:
+            dict: A dictionary of reset ConversableAgent instances, keyed like create_agents.
+        """
+        with self._lock:
+            agents = self._idle.pop() if self._idle else None
+        if agents is None:
+            logger.info("AgentPool: no idle agent set available, creating a new one.")
+            agents = AgentFactorySequential.create_agents(**self._factory_kwargs)
+        for agent in agents.values():
+            agent.reset()
+        for agent in self._extra_validators.get(id(agents), []):
+            agent.reset()
+        return agents
+
+    def release(self, agents: Dict[str, ConversableAgent]) -> None:
+        """Return a checked-out agent set to the pool."""
+        with self._lock:
+            self._idle.append(agents)
+
+    def sql_validators(self, agents: Dict[str, ConversableAgent], count: int) -> List[ConversableAgent]:
+        """
+        Get `count` distinct SQLValidators for a checked-out set, creating any that are missing.
+
+        Args:
+            agents (Dict[str, ConversableAgent]): A set obtained from acquire().
+            count (int): How many validators are needed.
+
+        Returns:
+            List[ConversableAgent]: The set's own SQLValidator followed by reusable extras.
+        """
+        extras = self._extra_validators.setdefault(id(agents), [])
+        while len(extras) < count - 1:
+            extras.append(AgentFactorySequential.create_sql_validator(**self._factory_kwargs))
+        return [agents["SQLValidator"]] + extras[:max(count - 1, 0)]
+
+    def prewarm(self) -> None:
+        """Build one agent set up front so the first query doesn't pay for it."""
+        self.release(self.acquire())
+
+
+@functools.lru_cache(maxsize=8)
+def get_agent_pool(api_key: str, model: str, temperature: float) -> AgentPool:
+    """
+    Get the shared AgentPool for a given LLM configuration.
+
+    Returns:
+        AgentPool: One pool per (api_key, model, temperature).
+    """
+    return AgentPool(api_key=api_key, model=model, temperature=temperature)
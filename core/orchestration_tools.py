@@ -1,149 +1,295 @@
-
-import logging
-import json
-from typing import List, Dict, Any
-from config.settings import get_settings
-from tools.db_tools import get_complete_schema, query_database, get_data_dictionary_columns
-
-logger = logging.getLogger(__name__)
-settings = get_settings()
-CARDINALITY_THRESHOLD = 25
-SAMPLE_LIMIT = 5
-
-def build_m_schema_string(tables: List[str], columns: List[str]) -> str:
-    """
-    Constructs the M-Schema string based on a focused list of tables and columns.
-
-    This function is a critical part of the pipeline. It:
-    1. Normalizes all table and column names to be fully qualified.
-    2. Fetches the physical schema (data types, PKs, FKs).
-    3. Fetches the semantic schema (descriptions from the data dictionary if available).
-    4. Implements "Smart Sampling":
-        - For low-cardinality columns (<= CARDINALITY_THRESHOLD), it fetches ALL unique values.
-        - For high-cardinality columns, it fetches a small, random sample.
-    5. Assembles all this information into the final M-Schema string for the SQLGenerator.
-
-    Args:
-        tables (List[str]): List of relevant table names.
-        columns (List[str]): List of relevant column names.
-
-    Returns:
-        str: A formatted string representing the M-Schema, or an error string if it fails.
-    """
-    logger.info(f"Building M-Schema for tables: {tables} and columns: {columns}")
-    if not tables or not columns:
-        return "/* M-Schema Error: No tables or columns were provided to the builder. */"
-
-    try:
-        if not settings.DB_SCHEMAS:
-            raise ValueError("DB_SCHEMAS is not configured in settings.")
-        data_schema_name = settings.DB_SCHEMAS[0]
-
-        # --- Step 1: Normalize all table and column names ---
-        normalized_columns = []
-        for col in columns:
-            parts = col.split('.')
-            if len(parts) == 2:
-                normalized_columns.append(f"{data_schema_name}.{col}")
-            elif len(parts) == 3:
-                normalized_columns.append(col)
-            else:
-                logger.warning(f"Skipping malformed column name during normalization: {col}")
-        columns = normalized_columns
-        
-        tables_to_build = set()
-        for t in tables:
-            if '.' in t:
-                tables_to_build.add(t)
-            else:
-                tables_to_build.add(f"{data_schema_name}.{t}")
-        
-        logger.info(f"Normalized tables: {tables_to_build}, columns: {columns}")
-
-        # --- Step 2: Fetch base metadata ---
-        full_physical_schema = get_complete_schema()
-        column_descriptions_dd = get_data_dictionary_columns(table_names=[t.split('.')[-1] for t in tables_to_build])
-
-        # --- Step 3: Build the M-Schema string ---
-        m_schema_parts = [f"【DB_ID】 {data_schema_name}\n【Schema】"]
-        
-        for fq_table_name in tables_to_build:
-            if fq_table_name not in full_physical_schema:
-                logger.warning(f"Table '{fq_table_name}' not found in physical schema. Skipping.")
-                continue
-
-            table_name_only = fq_table_name.split('.')[-1]
-            m_schema_parts.append(f"# Table: {fq_table_name}\n[")
-            
-            selected_cols_for_this_table = {c.split('.')[-1] for c in columns if c.startswith(fq_table_name)}
-            physical_cols = full_physical_schema.get(fq_table_name, [])
-
-            for col_info in physical_cols:
-                col_name = col_info['name']
-                if col_name not in selected_cols_for_this_table:
-                    continue
-                
-                # Get semantic description
-                col_desc = "No description available."
-                if table_name_only in column_descriptions_dd:
-                    for desc_item in column_descriptions_dd.get(table_name_only, []):
-                        if desc_item.get("column_name") == col_name:
-                            col_desc = desc_item.get("column_description", col_desc)
-                            break
-                
-                # --- Smart Sampler Logic ---
-                sample_values = []
-                label = "Sample Values" # Default label
-                try:
-                    # 1. Get the count of distinct values to decide on a strategy
-                    count_query = f'SELECT COUNT(DISTINCT "{col_name}") AS unique_count FROM "{data_schema_name}"."{table_name_only}";'
-                    count_result = query_database(count_query)
-                    unique_count = count_result[0]['unique_count'] if count_result and 'unique_count' in count_result[0] else 0
-
-                    # 2. Choose strategy based on cardinality
-                    if 0 < unique_count <= CARDINALITY_THRESHOLD:
-                        # Low cardinality: get all unique values
-                        logger.info(f"Fetching all {unique_count} unique values for low-cardinality column: {fq_table_name}.{col_name}")
-                        sample_query = f'SELECT DISTINCT "{col_name}" FROM "{data_schema_name}"."{table_name_only}" WHERE "{col_name}" IS NOT NULL ORDER BY "{col_name}";'
-                        label = "All Unique Values" # Hint to the LLM that this list is complete
-                    else:
-                        # High cardinality: get a small sample
-                        logger.info(f"Fetching {SAMPLE_LIMIT} samples for high-cardinality column: {fq_table_name}.{col_name} (total unique: {unique_count})")
-                        sample_query = f'SELECT DISTINCT "{col_name}" FROM "{data_schema_name}"."{table_name_only}" WHERE "{col_name}" IS NOT NULL LIMIT {SAMPLE_LIMIT};'
-                        label = "Sample Values"
-
-                    # 3. Execute the chosen query and format results
-                    samples_result = query_database(sample_query)
-                    if isinstance(samples_result, list) and samples_result and "error" not in samples_result[0]:
-                        raw_values = [list(row.values())[0] for row in samples_result]
-                        for val in raw_values:
-                            if hasattr(val, 'strftime'):
-                                sample_values.append(val.strftime('%Y-%m-%d %H:%M:%S' if ':' in str(val) else '%Y-%m-%d'))
-                            else:
-                                sample_values.append(str(val))
-                except Exception as e:
-                    logger.error(f"Failed to get smart samples for {fq_table_name}.{col_name}: {e}")
-                    # Keep sample_values as an empty list on error
-                # --- End Smart Sampler Logic ---
-
-                # Assemble the final column string
-                pk_info = "Primary Key, " if col_info.get('primary_key') else ""
-                col_type = col_info['type']
-                m_schema_parts.append(f"  ({col_name}:{col_type}, {pk_info}{col_desc}, {label}: {sample_values})")
-            
-            m_schema_parts.append("]\n")
-
-        # --- Step 4: Add Foreign Key relationships ---
-        m_schema_parts.append("【Foreign keys】")
-        for fq_table_name in tables_to_build:
-             if fq_table_name in full_physical_schema:
-                for col_info in full_physical_schema[fq_table_name]:
-                    if 'foreign_key' in col_info:
-                        fk = col_info['foreign_key']
-                        m_schema_parts.append(f"{fq_table_name}.{col_info['name']} = {fk['table']}.{fk['column']}")
-
-        return "\n".join(m_schema_parts)
-
-    except Exception as e:
-        logger.error(f"A critical error occurred while building M-Schema: {e}", exc_info=True)
+
+import asyncio
+import datetime
+import functools
+import hashlib
+import io
+import logging
+import orjson
+from collections import defaultdict
+from typing import List, Dict, Any, Tuple
+from config.settings import get_settings
+from tools.cache import ttl_cache
+from tools.db_tools import get_complete_schema, query_database_prepared, get_data_dictionary_columns, get_schema_version
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+CARDINALITY_THRESHOLD = 25
+SAMPLE_LIMIT = 5
+SAMPLER_CONCURRENCY = 16  # Max tables sampled at once across all requests
+# Column types that can plausibly hold a short, enumerable value list. Other types (measures,
+# timestamps, dates) skip the distinct-count probe and always get a small sample.
+LOW_CARDINALITY_CANDIDATE_TYPES = frozenset({
+    "text", "character varying", "character", "USER-DEFINED", "boolean", "smallint", "integer", "bigint",
+})
+
+# Column types whose arrays psycopg2 decodes into Python lists. Arrays of anything else (enums,
+# uuid, json, ...) would arrive as a '{a,b}' literal, so those are sampled as text[] instead.
+NATIVE_ARRAY_TYPES = frozenset({
+    "text", "character varying", "character", "boolean", "smallint", "integer", "bigint", "numeric",
+    "real", "double precision", "date", "timestamp without time zone", "timestamp with time zone",
+})
+
+_sampler_semaphore = asyncio.Semaphore(SAMPLER_CONCURRENCY)
+
+
+def _format_sample_values(raw_values: List[Any]) -> Tuple[str, ...]:
+    # Values come from one Postgres array, so they share a type: pick the format once
+    first = raw_values[0] if raw_values else None
+    if isinstance(first, datetime.datetime):
+        fmt = '%Y-%m-%d %H:%M:%S'
+    elif isinstance(first, datetime.date):
+        fmt = '%Y-%m-%d'
+    else:
+        return tuple(map(str, raw_values))
+    return tuple(val.strftime(fmt) for val in raw_values)
+
+
+@functools.lru_cache(maxsize=4096)
+def _render_column_line(col_name: str, col_type: str, is_primary_key: bool, col_desc: str,
+                        label: str, sample_values: Tuple[str, ...]) -> str:
+    """Renders one M-Schema column line; repeat requests with identical samples hit the cache."""
+    samples_str = "[" + ", ".join(map(repr, sample_values)) + "]"
+    pk_info = "Primary Key, " if is_primary_key else ""
+    return f"  ({col_name}:{col_type}, {pk_info}{col_desc}, {label}: {samples_str})\n"
+
+
+def _fetch_smart_samples(schema_name: str, table_name: str, col_infos: List[Dict[str, Any]]) -> Dict[str, Tuple[str, Tuple[str, ...]]]:
+    """
+    Runs the smart sampler for several columns of one table in at most two round-trips.
+
+    Phase A counts the distinct values of every column in a single statement, using
+    COUNT(*) over SELECT DISTINCT so PostgreSQL can use a HashAggregate instead of the
+    sort COUNT(DISTINCT) forces. Only columns whose type is in LOW_CARDINALITY_CANDIDATE_TYPES
+    are counted; Phase A is skipped when there are none. Phase B
+    fetches all values of the low-cardinality columns and a small sample of the others,
+    again in a single statement (one array per column, so each keeps its native type); if
+    that statement fails, the columns are sampled one by one so only the failing one is lost.
+    Both statements run as per-connection prepared statements, so a repeat sample of the
+    same table and columns skips parse and plan.
+
+    Args:
+        schema_name (str): Schema of the table.
+        table_name (str): Table name without schema.
+        col_infos (List[Dict[str, Any]]): Physical schema entries ('name', 'type') of the columns to sample.
+
+    Returns:
+        Dict[str, Tuple[str, Tuple[str, ...]]]: Maps each column to its label and formatted values.
+        Columns are missing from the result if sampling failed.
+    """
+    if not col_infos:
+        return {}
+    col_names = [col_info['name'] for col_info in col_infos]
+    qualified_table = f'"{schema_name}"."{table_name}"'
+    samples = {}
+    try:
+        # --- Phase A: distinct counts for the columns that can be low-cardinality ---
+        probe_indexes = [i for i, col_info in enumerate(col_infos) if col_info.get('type') in LOW_CARDINALITY_CANDIDATE_TYPES]
+        counts = {}
+        if probe_indexes:
+            distinct_ctes = ", ".join(
+                f'd_{i} AS (SELECT DISTINCT "{col_names[i]}" FROM {qualified_table} WHERE "{col_names[i]}" IS NOT NULL)'
+                for i in probe_indexes
+            )
+            count_exprs = ", ".join(f'(SELECT COUNT(*) FROM d_{i}) AS "n_{i}"' for i in probe_indexes)
+            count_result = query_database_prepared(f'WITH {distinct_ctes} SELECT {count_exprs};')
+            if isinstance(count_result, list) and count_result and "error" not in count_result[0]:
+                counts = count_result[0]
+            else:
+                # Sample every column as high-cardinality rather than lose the whole table
+                logger.error(f"Failed to count distinct values for {schema_name}.{table_name}: {count_result}")
+
+        # --- Phase B: choose a strategy per column and fetch all samples at once ---
+        sample_exprs = []
+        labels = []
+        for i, col_name in enumerate(col_names):
+            array_cast = "" if col_infos[i].get('type') in NATIVE_ARRAY_TYPES else "::text[]"
+            unique_count = counts.get(f"n_{i}") or 0
+            if 0 < unique_count <= CARDINALITY_THRESHOLD:
+                # Low cardinality: get all unique values
+                logger.info(f"Fetching all {unique_count} unique values for low-cardinality column: {schema_name}.{table_name}.{col_name}")
+                sample_exprs.append(f'ARRAY(SELECT DISTINCT "{col_name}" FROM {qualified_table} WHERE "{col_name}" IS NOT NULL ORDER BY "{col_name}"){array_cast} AS "s_{i}"')
+                labels.append("All Unique Values") # Hint to the LLM that this list is complete
+            else:
+                # High cardinality: get a small sample
+                logger.info(f"Fetching {SAMPLE_LIMIT} samples for high-cardinality column: {schema_name}.{table_name}.{col_name} (total unique: {unique_count or 'not counted'})")
+                sample_exprs.append(f'ARRAY(SELECT DISTINCT "{col_name}" FROM {qualified_table} WHERE "{col_name}" IS NOT NULL LIMIT {SAMPLE_LIMIT}){array_cast} AS "s_{i}"')
+                labels.append("Sample Values")
+
+        samples_result = query_database_prepared(f'SELECT {", ".join(sample_exprs)};')
+        if isinstance(samples_result, list) and samples_result and "error" not in samples_result[0]:
+            sample_rows = [samples_result[0]] * len(sample_exprs)
+        else:
+            # One column that can't be sampled (e.g. json has no equality operator for DISTINCT)
+            # fails the whole statement, so retry column by column and only drop that one
+            logger.warning(f"Batched sampling failed for {schema_name}.{table_name}, sampling columns one by one: {samples_result}")
+            sample_rows = []
+            for i, sample_expr in enumerate(sample_exprs):
+                column_result = query_database_prepared(f'SELECT {sample_expr};')
+                if isinstance(column_result, list) and column_result and "error" not in column_result[0]:
+                    sample_rows.append(column_result[0])
+                else:
+                    logger.error(f"Failed to fetch samples for {schema_name}.{table_name}.{col_names[i]}: {column_result}")
+                    sample_rows.append(None)
+        for i, col_name in enumerate(col_names):
+            if sample_rows[i] is not None:
+                samples[col_name] = (labels[i], _format_sample_values(sample_rows[i].get(f"s_{i}") or []))
+    except Exception as e:
+        logger.error(f"Failed to get smart samples for {schema_name}.{table_name}: {e}")
+    return samples
+
+
+async def _fetch_smart_samples_async(schema_name: str, table_name: str, col_infos: List[Dict[str, Any]]) -> Dict[str, Tuple[str, Tuple[str, ...]]]:
+    """Runs _fetch_smart_samples on a worker thread, bounded by SAMPLER_CONCURRENCY."""
+    async with _sampler_semaphore:
+        return await asyncio.to_thread(_fetch_smart_samples, schema_name, table_name, col_infos)
+
+
+def _m_schema_cache_key(tables: List[str], columns: List[str]) -> str:
+    # Order-insensitive fingerprint of the request, tied to the current schema version
+    payload = orjson.dumps({"t": sorted(tables or []), "c": sorted(columns or []), "schema_ver": get_schema_version()})
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+@ttl_cache(
+    ttl_sec=settings.SCHEMA_CACHE_TTL_SEC,
+    maxsize=512,
+    key=_m_schema_cache_key,
+    cache_if=lambda m_schema: not m_schema.startswith("/*"),  # Never cache error strings
+)
+async def build_m_schema_string(tables: List[str], columns: List[str]) -> str:
+    """
+    Constructs the M-Schema string based on a focused list of tables and columns.
+
+    This function is a critical part of the pipeline. It:
+    1. Normalizes all table and column names to be fully qualified.
+    2. Fetches the physical schema (data types, PKs, FKs).
+    3. Fetches the semantic schema (descriptions from the data dictionary if available).
+    4. Implements "Smart Sampling" (batched per table, all tables sampled concurrently):
+        - For low-cardinality columns (<= CARDINALITY_THRESHOLD), it fetches ALL unique values.
+        - For high-cardinality columns, it fetches a small, random sample.
+        - Measures, timestamps and dates skip the cardinality probe and are always sampled.
+    5. Assembles all this information into the final M-Schema string for the SQLGenerator.
+
+    The rendered string is cached per (tables, columns) fingerprint for SCHEMA_CACHE_TTL_SEC
+    seconds, and dropped when the schema cache is invalidated.
+
+    Args:
+        tables (List[str]): List of relevant table names.
+        columns (List[str]): List of relevant column names.
+
+    Returns:
+        str: A formatted string representing the M-Schema, or an error string if it fails.
+    """
+    logger.info(f"Building M-Schema for tables: {tables} and columns: {columns}")
+    if not tables or not columns:
+        return "/* M-Schema Error: No tables or columns were provided to the builder. */"
+
+    try:
+        if not settings.DB_SCHEMAS:
+            raise ValueError("DB_SCHEMAS is not configured in settings.")
+        data_schema_name = settings.DB_SCHEMAS[0]
+
+        # --- Step 1: Normalize all table and column names ---
+        normalized_columns = []
+        for col in columns:
+            parts = col.split('.')
+            if len(parts) == 2:
+                normalized_columns.append(f"{data_schema_name}.{col}")
+            elif len(parts) == 3:
+                normalized_columns.append(col)
+            else:
+                logger.warning(f"Skipping malformed column name during normalization: {col}")
+        columns = normalized_columns
+        
+        tables_to_build = set()
+        for t in tables:
+            if '.' in t:
+                tables_to_build.add(t)
+            else:
+                tables_to_build.add(f"{data_schema_name}.{t}")
+        
+        logger.info(f"Normalized tables: {tables_to_build}, columns: {columns}")
+
+        # Index the selected columns by their table once: "schema.table.col" -> {"schema.table": {"col"}}
+        cols_by_table = defaultdict(set)
+        for col in columns:
+            fq_table_name, _, col_name = col.rpartition('.')
+            cols_by_table[fq_table_name].add(col_name)
+
+        # --- Step 2: Fetch base metadata (both lookups in parallel) ---
+        full_physical_schema, column_descriptions_dd = await asyncio.gather(
+            asyncio.to_thread(get_complete_schema),
+            asyncio.to_thread(get_data_dictionary_columns, table_names=[t.rpartition('.')[-1] for t in tables_to_build]),
+        )
+
+        # Index descriptions as {table: {column: description}} so each column is a dict lookup.
+        # Error/info payloads map to strings instead of lists and are skipped.
+        desc_index = {
+            table: {
+                item["column_name"]: item.get("column_description", "No description available.")
+                for item in items if isinstance(item, dict) and "column_name" in item
+            }
+            for table, items in column_descriptions_dd.items() if isinstance(items, list)
+        }
+
+        # --- Step 2b: Smart-sample every table concurrently ---
+        tables_found = [t for t in tables_to_build if t in full_physical_schema]
+        sampled = await asyncio.gather(*(
+            _fetch_smart_samples_async(
+                data_schema_name,
+                fq_table_name.rpartition('.')[-1],
+                [col_info for col_info in full_physical_schema[fq_table_name] if col_info['name'] in cols_by_table.get(fq_table_name, ())],
+            )
+            for fq_table_name in tables_found
+        ))
+        samples_by_table = dict(zip(tables_found, sampled))
+
+        # --- Step 3: Build the M-Schema string ---
+        buf = io.StringIO()
+        buf.write(f"【DB_ID】 {data_schema_name}\n【Schema】\n")
+        fk_lines = []  # Foreign keys are collected in the same pass and written in Step 4
+        
+        for fq_table_name in tables_to_build:
+            if fq_table_name not in full_physical_schema:
+                logger.warning(f"Table '{fq_table_name}' not found in physical schema. Skipping.")
+                continue
+
+            table_name_only = fq_table_name.rpartition('.')[-1]
+            buf.write(f"# Table: {fq_table_name}\n[\n")
+            
+            selected_cols_for_this_table = cols_by_table.get(fq_table_name, set())
+            physical_cols = full_physical_schema.get(fq_table_name, [])
+            samples_by_col = samples_by_table[fq_table_name]
+
+            for col_info in physical_cols:
+                col_name = col_info['name']
+                if 'foreign_key' in col_info:
+                    fk = col_info['foreign_key']
+                    fk_lines.append(f"\n{fq_table_name}.{col_name} = {fk['table']}.{fk['column']}")
+                if col_name not in selected_cols_for_this_table:
+                    continue
+                
+                # Get semantic description
+                col_desc = desc_index.get(table_name_only, {}).get(col_name, "No description available.")
+                
+                # --- Smart Sampler Logic ---
+                # Falls back to an empty sample list if sampling failed for this table
+                label, sample_values = samples_by_col.get(col_name, ("Sample Values", ()))
+
+                # Assemble the final column string
+                buf.write(_render_column_line(
+                    col_name, col_info['type'], bool(col_info.get('primary_key')), col_desc, label, sample_values
+                ))
+            
+            buf.write("]\n\n")
+
+        # --- Step 4: Add Foreign Key relationships ---
+        buf.write("【Foreign keys】")
+        buf.writelines(fk_lines)
+
+        return buf.getvalue()
+
+    except Exception as e:
+        logger.error(f"A critical error occurred while building M-Schema: {e}", exc_info=True)
         return f"/* Error: A critical error occurred in the M-Schema builder. Details: {e} */"
\ No newline at end of file
@@ -1,8 +1,17 @@
+import io
 import logging
 from pathlib import Path
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 
+# The Arrow CSV reader parses on all cores; fall back to pandas' C parser if pyarrow is missing
+try:
+    import pyarrow  # noqa: F401
+    READ_CSV_KWARGS = {"engine": "pyarrow", "dtype_backend": "pyarrow"}
+except ImportError:
+    READ_CSV_KWARGS = {}
+
 # --- CONFIGURATION ---
 DB_PARAMS = {
     "user": "dpande",
@@ -20,6 +29,13 @@ CSV_DIRECTORY = "./walmart_data"
 
 # Action to take if tables already exist
 IF_TABLE_EXISTS = 'replace' 
+
+# Rows per COPY batch; bounds the size of the in-memory CSV buffer
+COPY_CHUNK_ROWS = 1_000_000
+
+# Set to True to skip the load and only refresh the materialized views, e.g. after 'sales' was
+# changed outside this script (the agents read 'store_state', which is otherwise left stale)
+REFRESH_VIEWS_ONLY = False
 # --- END OF CONFIGURATION ---
 
 # --- LOGGING SETUP ---
@@ -32,6 +48,38 @@ logging.basicConfig(
     ]
 )
 
+def copy_dataframe(connection, df, table_name):
+    """
+    Bulk-loads a DataFrame into an existing table with PostgreSQL COPY.
+
+    COPY streams rows in a single command instead of the parameterized multi-row INSERTs
+    issued by to_sql, which is an order of magnitude faster for the melted sales table.
+    Runs on the DBAPI connection underneath `connection`, so it joins its transaction.
+    """
+    columns = ", ".join(f'"{col}"' for col in df.columns)
+    copy_sql = f'COPY {TARGET_SCHEMA}."{table_name}" ({columns}) FROM STDIN WITH (FORMAT csv)'
+    with connection.connection.cursor() as cursor:
+        for start in range(0, len(df), COPY_CHUNK_ROWS):
+            buf = io.StringIO()
+            # NaN is written as an empty unquoted field, which COPY reads as NULL
+            df.iloc[start:start + COPY_CHUNK_ROWS].to_csv(buf, index=False, header=False)
+            buf.seek(0)
+            cursor.copy_expert(copy_sql, buf)
+
+
+def refresh_materialized_views(connection):
+    """
+    Brings the materialized views derived from 'sales', 'calendar' and 'sell_prices' up to date.
+
+    A full load rebuilds them itself; run this whenever those tables change outside this script.
+    """
+    # The unique index on store_id lets store_state refresh without blocking the agents' reads
+    connection.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {TARGET_SCHEMA}.store_state;"))
+    logging.info("-> Refreshed 'store_state'.")
+    connection.execute(text(f"REFRESH MATERIALIZED VIEW {TARGET_SCHEMA}.sales_fact;"))
+    logging.info("-> Refreshed 'sales_fact'.")
+
+
 def main():
     """
     Transforms and loads the M5 competition data into a relational PostgreSQL schema,
@@ -42,6 +90,13 @@ def main():
     db_url = f"postgresql+psycopg2://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}"
     engine = create_engine(db_url)
 
+    if REFRESH_VIEWS_ONLY:
+        logging.info("REFRESH_VIEWS_ONLY is set. Refreshing the materialized views without loading data...")
+        with engine.begin() as connection:
+            refresh_materialized_views(connection)
+        logging.info("--- SCRIPT FINISHED ---")
+        return
+
     csv_path = Path(CSV_DIRECTORY)
     if not csv_path.is_dir():
         logging.error(f"Error: CSV directory not found: '{CSV_DIRECTORY}'")
@@ -50,9 +105,15 @@ def main():
     # --- Step 1: Read all source CSVs ---
     try:
         logging.info("Reading source CSV files into memory...")
-        calendar_df = pd.read_csv(csv_path / 'calendar.csv', parse_dates=['date'])
-        sell_prices_df = pd.read_csv(csv_path / 'sell_prices.csv')
-        sales_eval_df = pd.read_csv(csv_path / 'sales_train_evaluation.csv')
+        calendar_df = pd.read_csv(csv_path / 'calendar.csv', parse_dates=['date'], **READ_CSV_KWARGS)
+        sell_prices_df = pd.read_csv(csv_path / 'sell_prices.csv', **READ_CSV_KWARGS)
+        # Read the ~1900 day columns as int16 up front instead of expanding them to int64
+        sales_header = pd.read_csv(csv_path / 'sales_train_evaluation.csv', nrows=0).columns
+        sales_eval_df = pd.read_csv(
+            csv_path / 'sales_train_evaluation.csv',
+            dtype={col: 'int16' for col in sales_header if col.startswith('d_')},
+            **READ_CSV_KWARGS,
+        )
         logging.info("All CSV files read successfully.")
     except FileNotFoundError as e:
         logging.error(f"File not found: {e}. Make sure 'calendar.csv', 'sell_prices.csv', and 'sales_train_evaluation.csv' are in '{CSV_DIRECTORY}'.")
@@ -61,18 +122,30 @@ def main():
     # --- Step 2: Melt the sales data to get 'd' and 'sales' columns ---
     logging.info("Transforming 'sales_train_evaluation.csv' from wide to long format...")
     id_vars = ['id', 'item_id', 'dept_id', 'cat_id', 'store_id', 'state_id']
-    day_vars = [col for col in sales_eval_df.columns if col.startswith('d_')]
+    day_mask = sales_eval_df.columns.str.startswith('d_')
+    day_vars = sales_eval_df.columns[day_mask]
     
-    sales_long_df = pd.melt(
-        sales_eval_df,
-        id_vars=id_vars,
-        value_vars=day_vars,
-        var_name='d',
-        value_name='sales'
-    )
-    # Filter out days with zero sales to reduce table size, which is a common practice for this dataset
-    sales_long_df = sales_long_df[sales_long_df['sales'] > 0]
+    # Melt with NumPy instead of pd.melt: flatten the (items x days) matrix and keep only the
+    # non-zero cells, so the id columns are only ever materialized for rows we actually load.
+    # Filtering out days with zero sales reduces table size, which is a common practice for this dataset
+    n_days = len(day_vars)
+    sales_values = sales_eval_df.loc[:, day_mask].to_numpy(dtype='int16').reshape(-1)
+    nonzero = np.flatnonzero(sales_values > 0)
+    row_idx, day_idx = np.divmod(nonzero, n_days)
+
+    sales_long_df = pd.DataFrame({col: sales_eval_df[col].to_numpy()[row_idx] for col in id_vars})
+    # Store 'd' as its integer day number ("d_1" -> 1): int keys are smaller than text and faster to join
+    day_numbers = day_vars.str.removeprefix('d_').astype('int32').to_numpy()
+    sales_long_df['d'] = day_numbers[day_idx]
+    # Daily unit sales per item stay far below the int16 limit
+    sales_long_df['sales'] = sales_values[nonzero].astype('int16')
     logging.info(f"Sales data transformed. The new 'sales' table has {len(sales_long_df)} rows (only includes non-zero sales days).")
+
+    # Downcast the remaining wide numeric columns; to_sql maps these to INTEGER / REAL
+    calendar_df['wm_yr_wk'] = calendar_df['wm_yr_wk'].astype('int32')
+    calendar_df['d'] = calendar_df['d'].str.removeprefix('d_').astype('int32')
+    sell_prices_df['wm_yr_wk'] = sell_prices_df['wm_yr_wk'].astype('int32')
+    sell_prices_df['sell_price'] = sell_prices_df['sell_price'].astype('float32')
     
     # Create a dictionary of the final DataFrames to be loaded
     final_dataframes = {
@@ -89,18 +162,28 @@ def main():
                 logging.info(f"Ensuring schema '{TARGET_SCHEMA}' exists...")
                 connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {TARGET_SCHEMA};"))
 
+                # The materialized views are derived from the tables below and rebuilt at the end
+                connection.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {TARGET_SCHEMA}.sales_fact;"))
+                connection.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {TARGET_SCHEMA}.store_state;"))
+
+                if IF_TABLE_EXISTS == 'replace':
+                    # Drop up front with CASCADE: the sales -> calendar foreign key would otherwise
+                    # block replacing 'calendar' on a re-run
+                    for table_name in final_dataframes:
+                        connection.execute(text(f"DROP TABLE IF EXISTS {TARGET_SCHEMA}.{table_name} CASCADE;"))
+
                 # Load the tables
                 for table_name, df in final_dataframes.items():
                     logging.info(f"Loading data into table: '{TARGET_SCHEMA}.{table_name}'...")
-                    df.to_sql(
+                    # Let pandas create the table from the column dtypes, then stream the rows with COPY
+                    df.head(0).to_sql(
                         name=table_name,
                         con=connection, # Use the connection within the transaction
                         schema=TARGET_SCHEMA,
                         if_exists=IF_TABLE_EXISTS,
                         index=False,
-                        chunksize=20000,
-                        method='multi'
                     )
+                    copy_dataframe(connection, df, table_name)
                     logging.info(f"Successfully loaded '{table_name}'.")
 
                 # --- Step 4: Add Primary Keys and Foreign Keys ---
@@ -126,6 +209,10 @@ def main():
                 """))
                 logging.info("-> Added Foreign Key from sales(d) to calendar(d).")
 
+                # Postgres does not index the referencing side of a foreign key, so index sales(d) explicitly
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_sales_d ON {TARGET_SCHEMA}.sales (d);"))
+                logging.info("-> Added Index on sales(d) to speed up joins with calendar.")
+
                 # REQUIREMENT 2: Linking 'calendar' and 'sell_prices'
                 # This is an indirect relationship that the agent must infer through a JOIN.
                 # To help the agent, we can add a FK from 'sell_prices' to 'calendar' on 'wm_yr_wk'.
@@ -134,6 +221,31 @@ def main():
                 connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_calendar_wm_yr_wk ON {TARGET_SCHEMA}.calendar (wm_yr_wk);"))
                 logging.info("-> Added Index on calendar(wm_yr_wk) to speed up joins with sell_prices.")
 
+                # --- Step 5: Pre-join sales with calendar and sell_prices ---
+                # Nearly every analytic question joins these three tables; materializing the join once
+                # lets generated queries read a single, indexed relation instead.
+                logging.info("Creating the pre-joined 'sales_fact' materialized view...")
+                connection.execute(text(f"""
+                    CREATE MATERIALIZED VIEW {TARGET_SCHEMA}.sales_fact AS
+                    SELECT s.*, c.date, c.wm_yr_wk, c.event_name_1, p.sell_price
+                    FROM {TARGET_SCHEMA}.sales s
+                    JOIN {TARGET_SCHEMA}.calendar c USING (d)
+                    LEFT JOIN {TARGET_SCHEMA}.sell_prices p
+                      ON p.store_id = s.store_id AND p.item_id = s.item_id AND p.wm_yr_wk = c.wm_yr_wk;
+                """))
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_sales_fact_store_item_date ON {TARGET_SCHEMA}.sales_fact (store_id, item_id, date);"))
+                logging.info("-> Created 'sales_fact' with an index on (store_id, item_id, date).")
+
+                # Store -> state lookup: state filters on sell_prices join this on store_id alone
+                # instead of joining the whole sales table on three columns. Refresh it with
+                # REFRESH_VIEWS_ONLY whenever 'sales' changes outside this script.
+                connection.execute(text(f"""
+                    CREATE MATERIALIZED VIEW {TARGET_SCHEMA}.store_state AS
+                    SELECT DISTINCT store_id, state_id FROM {TARGET_SCHEMA}.sales;
+                """))
+                connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_store_state_store_id ON {TARGET_SCHEMA}.store_state (store_id);"))
+                logging.info("-> Created 'store_state' with a unique index on store_id.")
+
             # The transaction is automatically committed here if everything succeeds
             logging.info("All tables loaded and keys created successfully. Transaction committed.")
 
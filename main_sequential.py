@@ -1,13 +1,21 @@
 import logging
+import logging.handlers
+import queue
 import uuid
-import datetime
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from fastapi import FastAPI, Request, Response 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import uvicorn
 import os
-import sys 
-import io  
+import orjson
+
+try:
+    # libuv-based event loop: cheaper socket I/O for the many concurrent LLM calls per request
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from config.settings import get_settings
 from api.routes.agent_sequential import router as agent_router 
@@ -19,131 +27,106 @@ if not os.path.exists(LOG_DIR_FOR_REQUESTS):
     os.makedirs(LOG_DIR_FOR_REQUESTS, exist_ok=True)
 
 LOG_FORMAT_STRING = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-logging.basicConfig(
-    level=getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO),
-    format=LOG_FORMAT_STRING,
-)
+LOG_QUEUE_SIZE = 10000
+REQUEST_LOG_FILE = os.path.join(LOG_DIR_FOR_REQUESTS, "requests.jsonl")
+
+# The id of the /query request being handled; copied into worker threads by asyncio.to_thread
+current_req_id: ContextVar = ContextVar("req_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps each record with the current request id. Must run in the emitting thread."""
+
+    def filter(self, record):
+        record.req_id = current_req_id.get()
+        return True
+
+
+class JsonLineFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line for the request log sink."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "req_id": getattr(record, "req_id", None),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+# Records are pushed onto a bounded queue and written by a dedicated listener thread
+log_level = getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO)
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter(LOG_FORMAT_STRING))
+# One append-only sink for every request; split per request with e.g. `grep '"req_id":"<id>"'`
+request_log_handler = logging.handlers.WatchedFileHandler(REQUEST_LOG_FILE, encoding='utf-8')
+request_log_handler.setFormatter(JsonLineFormatter())
+request_log_handler.addFilter(lambda record: getattr(record, "req_id", None) is not None)
+
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RequestIdFilter())
+root_logger = logging.getLogger()
+root_logger.setLevel(log_level)
+root_logger.handlers[:] = [queue_handler]
+log_listener = logging.handlers.QueueListener(log_queue, console_handler, request_log_handler)
+log_listener.start()
+
 app_main_logger = logging.getLogger(__name__)
-app_main_logger.info(f"Logging full request output to directory: {LOG_DIR_FOR_REQUESTS}")
-
-
-class CaptureOutputToFile:
-    def __init__(self, filepath, also_to_console=True):
-        self.filepath = filepath
-        self.also_to_console = also_to_console
-        self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
-        self.file_handle = None
-
-    def __enter__(self):
-        self.file_handle = open(self.filepath, 'a', encoding='utf-8')
-        
-        class Tee(io.TextIOBase):
-            def __init__(self, stream1, stream2):
-                self.stream1 = stream1
-                self.stream2 = stream2
-            def write(self, s):
-                written_count = 0
-                try:
-                    if self.stream1 and not self.stream1.closed:
-                        self.stream1.write(s)
-                        written_count = len(s)
-                except Exception: pass 
-                try:
-                    if self.stream2 and not self.stream2.closed:
-                        self.stream2.write(s)
-                        if written_count == 0: written_count = len(s) 
-                except Exception: pass
-                return written_count
-            def flush(self):
-                try:
-                    if self.stream1 and not self.stream1.closed: self.stream1.flush()
-                except Exception: pass
-                try:
-                    if self.stream2 and not self.stream2.closed: self.stream2.flush()
-                except Exception: pass
-            def isatty(self): 
-                if self.stream2 and hasattr(self.stream2, 'isatty'): return self.stream2.isatty()
-                return False
-
-        if self.also_to_console:
-            sys.stdout = Tee(self.file_handle, self.original_stdout)
-            sys.stderr = Tee(self.file_handle, self.original_stderr)
-        else:
-            sys.stdout = self.file_handle
-            sys.stderr = self.file_handle
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self.original_stdout
-        sys.stderr = self.original_stderr
-        if self.file_handle:
-            self.file_handle.close()
+app_main_logger.info(f"Logging request output to: {REQUEST_LOG_FILE}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app_main_logger.info("Initializing application resources")
+    init_db_pool()
+    app_main_logger.info("Application startup complete")
+    yield
+    app_main_logger.info("Application shutting down")
+    close_db_pool()
+    app_main_logger.info("Resources cleaned up successfully")
+    log_listener.stop()  # Drains the queue and flushes the request log
 
 app = FastAPI(
     title="Database Agent API",
     description="API for interacting with database agents to execute SQL queries.",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 @app.middleware("http")
 async def capture_all_output_to_file_middleware(request: Request, call_next):
     is_target_request = False
     target_path_prefix = str(agent_router.prefix) if agent_router.prefix else ""
-    # Ensure the path check is precise for your POST query endpoint
-    if request.method == "POST" and request.url.path == f"{target_path_prefix}/query":
+    # Ensure the path check is precise for the POST query endpoints (JSON and CSV)
+    if request.method == "POST" and request.url.path in (f"{target_path_prefix}/query", f"{target_path_prefix}/query/csv"):
         is_target_request = True
 
     if not is_target_request:
         response = await call_next(request)
         return response
 
-    root_logger_instance = logging.getLogger() 
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     req_id = str(uuid.uuid4())[:8]
-    output_filename = os.path.join(LOG_DIR_FOR_REQUESTS, f"req_full_output_{timestamp}_{req_id}.log")
-
-    logging_file_handler = logging.FileHandler(output_filename, mode='a', encoding='utf-8')
-    logging_file_handler.setFormatter(logging.Formatter(LOG_FORMAT_STRING)) 
-    logging_file_handler.setLevel(root_logger_instance.getEffectiveLevel()) 
-    root_logger_instance.addHandler(logging_file_handler)
-    
-    app_main_logger.info(f"--- CAPTURING ALL OUTPUT for req_id {req_id} to: {output_filename} ---")
-
-    # The also_to_console=True means prints still go to terminal
-    with CaptureOutputToFile(filepath=output_filename, also_to_console=True):
-        try:
-            print(f"--- STDOUT/STDERR REDIRECTION ACTIVE (ReqID: {req_id}, Time: {datetime.datetime.now()}) ---", file=sys.stdout)
-            response = await call_next(request) 
-            print(f"--- STDOUT/STDERR REDIRECTION ENDED (ReqID: {req_id}, Time: {datetime.datetime.now()}) ---", file=sys.stdout)
-            app_main_logger.info(f"--- FINISHED CAPTURING OUTPUT for req_id {req_id}. File: {output_filename} ---")
-            return response
-        except Exception as e:
-            print(f"--- EXCEPTION DURING REDIRECTED BLOCK (ReqID: {req_id}, Time: {datetime.datetime.now()}) ---\n{type(e).__name__}: {e}", file=sys.stderr)
-            # The error would have been logged by the root logger to the file if it was a standard log
-            # or by the print redirection if it was printed.
-            app_main_logger.error(f"--- ERROR DURING REQUEST (req_id {req_id}, output in {output_filename}): {e} ---")
-            raise 
-        finally:
-            root_logger_instance.removeHandler(logging_file_handler)
-            logging_file_handler.close()
-            app_main_logger.debug(f"--- Logging module file handler for {output_filename} removed. Stdout/stderr restored. ---")
+    req_id_token = current_req_id.set(req_id)
+    app_main_logger.info(f"--- CAPTURING ALL OUTPUT for req_id {req_id} to: {REQUEST_LOG_FILE} ---")
+    try:
+        response = await call_next(request)
+        app_main_logger.info(f"--- FINISHED CAPTURING OUTPUT for req_id {req_id} ---")
+        return response
+    except Exception as e:
+        app_main_logger.error(f"--- ERROR DURING REQUEST (req_id {req_id}, output in {REQUEST_LOG_FILE}): {e} ---")
+        raise
+    finally:
+        current_req_id.reset(req_id_token)
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 app.include_router(agent_router) 
 
-@app.on_event("startup")
-def startup_event():
-    app_main_logger.info("Initializing application resources")
-    init_db_pool()
-    app_main_logger.info("Application startup complete")
-
-@app.on_event("shutdown")
-def shutdown_event():
-    app_main_logger.info("Application shutting down")
-    close_db_pool()
-    app_main_logger.info("Resources cleaned up successfully")
-
 @app.get("/health")
 def health_check():
     app_main_logger.debug("Health check endpoint called.")
@@ -153,10 +136,10 @@ def health_check():
 async def generic_exception_handler(request: Request, exc: Exception):
     # This log goes to console AND the request-specific file (if active for this request)
     logging.getLogger().error(f"Uncaught exception by generic handler for {request.method} {request.url}: {str(exc)}", exc_info=True)
-    return JSONResponse(status_code=500, content={"error": "Internal server error", "detail": str(exc)})
+    return ORJSONResponse(status_code=500, content={"error": "Internal server error", "detail": str(exc)})
 
 if __name__ == "__main__":
-    app_main_logger.info(f"Starting Uvicorn server on {settings.API_HOST}:{settings.API_PORT}")
+    app_main_logger.info(f"Starting Uvicorn server on {settings.API_HOST}:{settings.API_PORT} ({'uvloop' if uvloop else 'asyncio'} event loop)")
     print("Im starting the sequential agent API server...")  # This will go to the console and the log file if redirection is active
     uvicorn.run(
         "main_sequential:app",
@@ -165,4 +148,5 @@ if __name__ == "__main__":
         reload=getattr(settings, "RELOAD_APP", False),
         log_config=None,
         log_level=settings.LOG_LEVEL.lower(),
+        loop="uvloop" if uvloop else "asyncio",
     )
@@ -0,0 +1,99 @@
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    A small thread-safe mapping whose entries expire `ttl_sec` seconds after they are stored.
+
+    Holds at most `maxsize` entries; when full, expired entries are evicted first, then the
+    oldest. Values are returned as-is, so callers must not mutate them.
+    """
+
+    _missing = object()
+
+    def __init__(self, ttl_sec: float, maxsize: int = 32):
+        self.ttl_sec = ttl_sec
+        self.maxsize = maxsize
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.maxsize:
+                for stale_key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+                    del self._entries[stale_key]
+                if len(self._entries) >= self.maxsize:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[key] = (now + self.ttl_sec, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def ttl_cache(ttl_sec: float, maxsize: int = 32, key: Optional[Callable[..., Hashable]] = None,
+              cache_if: Optional[Callable[[Any], bool]] = None):
+    """
+    Memoize a function's results for `ttl_sec` seconds.
+
+    Meant for metadata lookups (schema, data dictionary) that are expensive to fetch but
+    change rarely. Cached values are returned as-is, so callers must not mutate them.
+    Works for both plain functions and coroutine functions.
+
+    Args:
+        ttl_sec (float): How long an entry stays valid.
+        maxsize (int): Maximum number of entries; expired, then oldest entries are evicted first.
+        key (Callable, optional): Builds the cache key from the call arguments.
+            Defaults to the positional and keyword arguments themselves.
+        cache_if (Callable, optional): Predicate on the result; results it rejects
+            (e.g. error payloads) are returned but not cached.
+
+    Returns:
+        A decorator. The wrapped function gains a `cache_clear()` method.
+    """
+    def decorator(func):
+        cache = TTLCache(ttl_sec, maxsize)
+        _missing = TTLCache._missing
+
+        def store(cache_key, value):
+            if cache_if is None or cache_if(value):
+                cache.set(cache_key, value)
+
+        def make_key(args, kwargs):
+            return key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                cache_key = make_key(args, kwargs)
+                value = cache.get(cache_key, _missing)
+                if value is _missing:
+                    value = await func(*args, **kwargs)
+                    store(cache_key, value)
+                return value
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                cache_key = make_key(args, kwargs)
+                value = cache.get(cache_key, _missing)
+                if value is _missing:
+                    value = func(*args, **kwargs)
+                    store(cache_key, value)
+                return value
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
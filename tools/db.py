@@ -1,8 +1,13 @@
 import psycopg2
+import psycopg2.errors
 import psycopg2.pool
 import psycopg2.extras
+import hashlib
 import logging
-from typing import Optional, Dict, Any, List
+import threading
+import time
+import weakref
+from typing import Optional, Dict, Any, List, Sequence
 
 from config.settings import get_settings
 
@@ -11,6 +16,23 @@ logger = logging.getLogger(__name__)
 
 # Global connection pool
 _pool = None
+# ThreadedConnectionPool fails immediately when exhausted; this makes callers queue instead
+_pool_slots = None
+_pool_init_lock = threading.Lock()
+
+# Names of the statements PREPAREd on each pooled connection; an entry goes away with its connection
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+# Statements whose last EXECUTE failed; they are DEALLOCATEd and prepared again on next use
+_failed_statements = weakref.WeakKeyDictionary()
+
+# Executions seen per query text, for deciding when an ad-hoc query is worth preparing
+_execution_counts: Dict[str, int] = {}
+_execution_counts_lock = threading.Lock()
+
+# When each pooled connection was last returned; only connections idle longer than DB_PING_IDLE_SEC are pinged
+_last_released = weakref.WeakKeyDictionary()
+_last_released_lock = threading.Lock()
 
 
 def init_db_pool():
@@ -21,23 +43,33 @@ def init_db_pool():
     Returns:
         The database connection pool
     """
-    global _pool
-    if _pool is None:
-        try:
-            logger.info("Creating database connection pool")
-            _pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=settings.DB_MIN_POOL_SIZE,
-                maxconn=settings.DB_MAX_POOL_SIZE,
-                user=settings.DB_USER,
-                password=settings.DB_PASSWORD,
-                host=settings.DB_HOST,
-                port=settings.DB_PORT,
-                database=settings.DB_NAME
-            )
-            logger.info("Database connection pool created successfully")
-        except Exception as e:
-            logger.error(f"Failed to create database connection pool: {str(e)}")
-            raise
+    global _pool, _pool_slots
+    # Tools run on worker threads, so two first callers must not each create a pool
+    with _pool_init_lock:
+        if _pool is None:
+            try:
+                logger.info("Creating database connection pool")
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    minconn=settings.DB_MIN_POOL_SIZE,
+                    maxconn=settings.DB_MAX_POOL_SIZE,
+                    user=settings.DB_USER,
+                    password=settings.DB_PASSWORD,
+                    host=settings.DB_HOST,
+                    port=settings.DB_PORT,
+                    database=settings.DB_NAME,
+                    # TCP keepalives so idle pooled connections aren't silently dropped by firewalls/NAT
+                    keepalives=1,
+                    keepalives_idle=settings.DB_KEEPALIVES_IDLE,
+                    keepalives_interval=settings.DB_KEEPALIVES_INTERVAL,
+                    keepalives_count=settings.DB_KEEPALIVES_COUNT,
+                    # Dictionary cursors by default, set once per connection rather than on every checkout
+                    cursor_factory=psycopg2.extras.RealDictCursor,
+                )
+                _pool_slots = threading.BoundedSemaphore(settings.DB_MAX_POOL_SIZE)
+                logger.info("Database connection pool created successfully")
+            except Exception as e:
+                logger.error(f"Failed to create database connection pool: {str(e)}")
+                raise
     return _pool
 
 
@@ -58,16 +90,133 @@ def get_db_connection():
     """
     Get a connection from the pool.
 
+    Waits up to DB_POOL_TIMEOUT seconds for a free connection instead of failing as soon
+    as the pool is exhausted. Connections that sat idle for more than DB_PING_IDLE_SEC are
+    pinged first and replaced if they no longer answer; recently used ones skip the round-trip.
+
     Returns:
         A database connection
+
+    Raises:
+        psycopg2.pool.PoolError: If no connection became available within DB_POOL_TIMEOUT.
     """
     pool = get_db_pool()
-    conn = pool.getconn()
-    # Enable dictionary cursor by default
-    conn.cursor_factory = psycopg2.extras.RealDictCursor
+    if not _pool_slots.acquire(timeout=settings.DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(
+            f"No database connection available within {settings.DB_POOL_TIMEOUT}s (pool size {settings.DB_MAX_POOL_SIZE})"
+        )
+    try:
+        conn = pool.getconn()
+        if not _is_alive(conn, check=_idle_for(conn) > settings.DB_PING_IDLE_SEC):
+            logger.warning("Discarding dead pooled database connection")
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
     return conn
 
 
+def _idle_for(conn) -> float:
+    with _last_released_lock:
+        last_released = _last_released.get(conn)
+    # A connection that was never released was just opened by the pool
+    return 0.0 if last_released is None else time.monotonic() - last_released
+
+
+def _is_alive(conn, check: bool = True) -> bool:
+    """Pre-ping a pooled connection before handing it out; with check=False only the closed flag is tested."""
+    if conn.closed:
+        return False
+    if not check:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def should_prepare(query: str) -> bool:
+    """
+    Records an execution of `query` and tells whether it should run as a prepared statement.
+
+    Mirrors psycopg 3's prepare_threshold: a query is prepared once it has already been
+    executed DB_PREPARE_THRESHOLD times (0 prepares it on first use, a negative value never).
+    Counts are kept per process rather than per connection, since the same generated SQL
+    is usually retried on whichever pooled connection is free.
+
+    Args:
+        query (str): The exact SQL text about to be executed
+
+    Returns:
+        bool: True if the caller should use execute_prepared
+    """
+    threshold = settings.DB_PREPARE_THRESHOLD
+    if threshold < 0:
+        return False
+    with _execution_counts_lock:
+        seen = _execution_counts.get(query, 0)
+        if seen >= threshold:
+            return True
+        if len(_execution_counts) >= settings.DB_PREPARED_MAX * 8:
+            _execution_counts.clear()
+        _execution_counts[query] = seen + 1
+    return False
+
+
+def execute_prepared(conn, cursor, query: str, params: Sequence[Any] = (), param_types: Sequence[str] = ()):
+    """
+    Execute a query through a server-side prepared statement.
+
+    The statement is named after a hash of the query text and PREPAREd the first time a
+    connection sees it; later calls on the same connection only send EXECUTE, skipping
+    parse and plan. Meant for queries that repeat verbatim, such as the generated
+    metadata/sampling queries and the fixed queries behind the query_prepared tool.
+
+    Args:
+        conn: The pooled connection the cursor belongs to
+        cursor: An open cursor on `conn`
+        query (str): SQL query, with $1, $2, ... placeholders if it takes parameters
+        params (Sequence[Any]): Values for the placeholders
+        param_types (Sequence[str]): Postgres types of the placeholders, e.g. ("text",)
+    """
+    signature = f"{query}|{','.join(param_types)}"
+    name = "s_" + hashlib.blake2b(signature.encode(), digest_size=8).hexdigest()
+    with _prepared_statements_lock:
+        prepared = _prepared_statements.setdefault(conn, set())
+        failed = _failed_statements.setdefault(conn, set())
+    if name in failed:
+        # The cached plan may be unusable (e.g. "cached plan must not change result type" after DDL),
+        # so start over; the DEALLOCATE runs here because the failed transaction was aborted
+        failed.discard(name)
+        prepared.discard(name)
+        cursor.execute(f"DEALLOCATE {name}")
+    if name not in prepared:
+        if len(prepared) >= settings.DB_PREPARED_MAX:
+            cursor.execute("DEALLOCATE ALL")
+            prepared.clear()
+            failed.clear()
+        type_list = f"({', '.join(param_types)})" if param_types else ""
+        cursor.execute(f"PREPARE {name}{type_list} AS {query}")
+        prepared.add(name)
+    try:
+        if params:
+            cursor.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", tuple(params))
+        else:
+            cursor.execute(f"EXECUTE {name}")
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Behind a transaction-pooling proxy the statement may live on another backend; prepare it again next time
+        prepared.discard(name)
+        raise
+    except psycopg2.Error:
+        # The statement still exists on this backend, so it has to be DEALLOCATEd before it can be prepared again
+        failed.add(name)
+        raise
+
+
 def release_connection(conn):
     """
     Release a connection back to the pool.
@@ -77,7 +226,10 @@ def release_connection(conn):
     """
     if conn:
         pool = get_db_pool()
+        with _last_released_lock:
+            _last_released[conn] = time.monotonic()
         pool.putconn(conn)
+        _pool_slots.release()
 
 
 def close_db_pool():
@@ -85,9 +237,10 @@ def close_db_pool():
     Close the database connection pool when shutting down the application.
     This should be called during application shutdown.
     """
-    global _pool
+    global _pool, _pool_slots
     if _pool:
         logger.info("Closing database connection pool")
         _pool.closeall()
         _pool = None
+        _pool_slots = None
         logger.info("Database connection pool closed")
\ No newline at end of file
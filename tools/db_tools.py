@@ -1,14 +1,54 @@
-from typing import List, Dict, Any, Union, Optional, Tuple
+from typing import List, Dict, Any, Union, Optional, Sequence, Tuple
+import csv
+import functools
+import io
 import logging
-import json
+import re
+import sys
+import threading
+import uuid
+from decimal import Decimal
+import orjson
+import psycopg2
+import psycopg2.extras
 import psycopg2.sql as sql
 
-from tools.db import get_db_pool, get_db_connection, release_connection
+from tools.db import get_db_pool, get_db_connection, release_connection, execute_prepared, should_prepare
+from tools.cache import TTLCache, ttl_cache
 from config.settings import get_settings
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+# Bumped on every invalidation so caches built from schema metadata can tell they are stale
+_schema_version = 0
+
+
+# Data dictionary columns per application table, so overlapping requests only query the tables not seen yet;
+# a table without DD entries is cached as an empty list
+_DD_COLUMNS_CACHE = TTLCache(ttl_sec=settings.SCHEMA_CACHE_TTL_SEC, maxsize=4096)
+
+
+def get_schema_version() -> int:
+    """Returns a counter that changes whenever invalidate_schema_cache() is called."""
+    return _schema_version
+
+
+def invalidate_schema_cache() -> None:
+    """
+    Drop all cached schema and data dictionary lookups.
+    Call this after DDL or data dictionary changes that must be visible before the TTL expires.
+    """
+    global _schema_version
+    _schema_version += 1
+    get_all_db_objects.cache_clear()
+    get_complete_schema.cache_clear()
+    get_complete_schema_compact.cache_clear()
+    get_data_dictionary_tables.cache_clear()
+    _DD_COLUMNS_CACHE.clear()
+    get_schema_bundle.cache_clear()
+    logger.info("Schema metadata cache invalidated.")
+
 
 def get_schemas() -> List[str]:
     """
@@ -19,79 +59,60 @@ def get_schemas() -> List[str]:
     return settings.DB_SCHEMAS
 
 
+# pg_class.relkind -> get_all_db_objects bucket; partitioned tables ('p') are listed as tables, as in information_schema
+_RELKIND_BUCKETS = {'r': 'tables', 'p': 'tables', 'v': 'views', 'm': 'materialized_views'}
+
+
+@ttl_cache(ttl_sec=settings.SCHEMA_CACHE_TTL_SEC, maxsize=1, cache_if=lambda result: any(result.values()))
 def get_all_db_objects() -> Dict[str, List[Dict[str, str]]]:
     """
     Get all database objects (tables, views, materialized views) from the configured schemas.
+    Results are cached for SCHEMA_CACHE_TTL_SEC seconds (see invalidate_schema_cache).
 
     Returns:
         Dict[str, List[Dict[str, str]]]: Dictionary with keys 'tables', 'views', 'materialized_views'
         containing information about each object.
     """
     schemas = get_schemas()
-    schema_list = ','.join(f"'{schema}'" for schema in schemas)
 
-    query = f"""
+    # Read straight from pg_class rather than the information_schema views, which join many
+    # more catalogs and check privileges row by row; one scan covers all three object types
+    objects_query = """
     SELECT
-        table_schema,
-        table_name,
-        'table' as object_type
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        c.relkind
     FROM
-        information_schema.tables
+        pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
     WHERE
-        table_schema IN ({schema_list})
-        AND table_type = 'BASE TABLE'
-    UNION ALL
-    SELECT
-        table_schema,
-        table_name,
-        'view' as object_type
-    FROM
-        information_schema.views
-    WHERE
-        table_schema IN ({schema_list})
-    UNION ALL
-    SELECT
-        schemaname as table_schema,
-        matviewname as table_name,
-        'materialized_view' as object_type
-    FROM
-        pg_matviews
-    WHERE
-        schemaname IN ({schema_list})
+        n.nspname = ANY(%s) AND c.relkind IN ('r', 'p', 'v', 'm')
     ORDER BY
-        table_schema, table_name;
+        n.nspname, c.relname;
     """
 
-    result = {
-        'tables': [],
-        'views': [],
-        'materialized_views': []
-    }
+    result = {'tables': [], 'views': [], 'materialized_views': []}
 
     conn = None
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            cursor.execute(query)
-            rows = cursor.fetchall()
-
-            for row in rows:
-                obj_info = {
-                    'schema': row['table_schema'],
-                    'name': row['table_name'],
-                    'full_name': f"{row['table_schema']}.{row['table_name']}"
-                }
-
-                if row['object_type'] == 'table':
-                    result['tables'].append(obj_info)
-                elif row['object_type'] == 'view':
-                    result['views'].append(obj_info)
-                elif row['object_type'] == 'materialized_view':
-                    result['materialized_views'].append(obj_info)
+            cursor.execute(objects_query, (list(schemas),))
+            # One dict lookup per row picks the output list
+            buckets = {relkind: result[object_type] for relkind, object_type in _RELKIND_BUCKETS.items()}
+            for row in cursor.fetchall():
+                # Every row carries a fresh copy of its schema name; interning keeps one string per schema
+                schema, name = sys.intern(row['table_schema']), row['table_name']
+                buckets[row['relkind']].append({
+                    'schema': schema,
+                    'name': name,
+                    'full_name': f"{schema}.{name}"
+                })
 
     except Exception as e:
         logger.error(f"Error retrieving database objects: {str(e)}")
         # Return empty results on error rather than raising to prevent cascading failures
+        result = {object_type: [] for object_type in result}
     finally:
         if conn:
             release_connection(conn)
@@ -99,122 +120,20 @@ def get_all_db_objects() -> Dict[str, List[Dict[str, str]]]:
     return result
 
 
+@ttl_cache(ttl_sec=settings.SCHEMA_CACHE_TTL_SEC, maxsize=1, cache_if=bool)
 def get_complete_schema() -> Dict[str, List[Dict[str, Any]]]:
     """
-    Get complete schema information for tables in the configured schemas.
+    Get complete schema information for tables, views and materialized views in the configured schemas.
+    Results are cached for SCHEMA_CACHE_TTL_SEC seconds (see invalidate_schema_cache).
 
     Returns:
         Dict[str, List[Dict[str, Any]]]: Dictionary mapping table names to lists of
         column information dictionaries.
     """
-    schemas = get_schemas()
-    schema_list = ','.join(f"'{schema}'" for schema in schemas)
-
-    schema_dict = {}
-
     conn = None
     try:
         conn = get_db_connection()
-
-        # Get all tables from the specified schemas
-        tables_query = f"""
-        SELECT table_schema, table_name
-        FROM information_schema.tables
-        WHERE table_schema IN ({schema_list})
-        ORDER BY table_schema, table_name;
-        """
-
-        with conn.cursor() as cursor:
-            cursor.execute(tables_query)
-            tables = cursor.fetchall()
-
-            for table_record in tables:
-                schema_name = table_record['table_schema']
-                table_name = table_record['table_name']
-                qualified_table_name = f"{schema_name}.{table_name}"
-
-                # Get column details for this table
-                columns_query = f"""
-                SELECT
-                    column_name,
-                    data_type,
-                    is_nullable,
-                    column_default,
-                    character_maximum_length
-                FROM
-                    information_schema.columns
-                WHERE
-                    table_schema = %s
-                    AND table_name = %s
-                ORDER BY
-                    ordinal_position;
-                """
-
-                cursor.execute(columns_query, (schema_name, table_name))
-                columns = cursor.fetchall()
-
-                # Format column information
-                columns_info = []
-                for col in columns:
-                    col_info = {
-                        'name': col['column_name'],
-                        'type': col['data_type'],
-                        'nullable': col['is_nullable'] == 'YES',
-                        'default': col['column_default'],
-                    }
-
-                    # Add character length for string types if applicable
-                    if col['character_maximum_length'] is not None:
-                        col_info['max_length'] = col['character_maximum_length']
-
-                    columns_info.append(col_info)
-
-                schema_dict[qualified_table_name] = columns_info
-
-            # Get foreign key constraints for each schema
-            for schema_name in schemas:
-                fk_query = """
-                SELECT
-                    tc.table_schema,
-                    tc.table_name,
-                    kcu.column_name,
-                    ccu.table_schema AS foreign_table_schema,
-                    ccu.table_name AS foreign_table_name,
-                    ccu.column_name AS foreign_column_name
-                FROM
-                    information_schema.table_constraints AS tc
-                    JOIN information_schema.key_column_usage AS kcu
-                      ON tc.constraint_name = kcu.constraint_name
-                      AND tc.table_schema = kcu.table_schema
-                    JOIN information_schema.constraint_column_usage AS ccu
-                      ON ccu.constraint_name = tc.constraint_name
-                      AND ccu.table_schema = tc.table_schema
-                WHERE tc.constraint_type = 'FOREIGN KEY' AND tc.table_schema = %s;
-                """
-
-                cursor.execute(fk_query, (schema_name,))
-                foreign_keys = cursor.fetchall()
-
-                # Add foreign key information to the schema dictionary
-                for fk in foreign_keys:
-                    table_name = f"{fk['table_schema']}.{fk['table_name']}"
-                    foreign_table = f"{fk['foreign_table_schema']}.{fk['foreign_table_name']}"
-
-                    # Ensure the table exists in our dictionary (it might be a view that wasn't captured above)
-                    if table_name not in schema_dict:
-                        continue
-
-                    # Look for the column in the columns list
-                    for col in schema_dict[table_name]:
-                        if col['name'] == fk['column_name']:
-                            if 'foreign_key' not in col:
-                                col['foreign_key'] = {}
-                            col['foreign_key'] = {
-                                'table': foreign_table,
-                                'column': fk['foreign_column_name']
-                            }
-                            break
-
+        return _read_complete_schema(conn)
     except Exception as e:
         logger.error(f"Error retrieving complete schema: {str(e)}")
         return {}  # Return empty dictionary on error rather than raising
@@ -222,6 +141,203 @@ def get_complete_schema() -> Dict[str, List[Dict[str, Any]]]:
         if conn:
             release_connection(conn)
 
+
+@ttl_cache(ttl_sec=settings.SCHEMA_CACHE_TTL_SEC, maxsize=1, cache_if=bool)
+def get_complete_schema_compact() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the complete schema in a columnar layout for the agents.
+
+    get_complete_schema repeats the 'name'/'type'/'nullable'/'default' keys for every
+    column, which costs tokens once serialized for an LLM. Here each table holds parallel
+    lists instead, plus column-keyed maps for the attributes most columns lack.
+    Results are cached for SCHEMA_CACHE_TTL_SEC seconds (see invalidate_schema_cache).
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Dictionary mapping table names to {"columns", "types",
+        "nullable"} lists; "defaults", "max_length" and "foreign_keys" ({column: value},
+        foreign keys as "schema.table.column") are present only when non-empty.
+    """
+    compact = {}
+    for table_name, columns_info in get_complete_schema().items():
+        table = {
+            'columns': [col['name'] for col in columns_info],
+            'types': [col['type'] for col in columns_info],
+            'nullable': [col['nullable'] for col in columns_info],
+        }
+        defaults = {col['name']: col['default'] for col in columns_info if col['default'] is not None}
+        max_length = {col['name']: col['max_length'] for col in columns_info if 'max_length' in col}
+        foreign_keys = {
+            col['name']: f"{col['foreign_key']['table']}.{col['foreign_key']['column']}"
+            for col in columns_info if 'foreign_key' in col
+        }
+        if defaults:
+            table['defaults'] = defaults
+        if max_length:
+            table['max_length'] = max_length
+        if foreign_keys:
+            table['foreign_keys'] = foreign_keys
+        compact[table_name] = table
+    return compact
+
+
+def _read_complete_schema(conn) -> Dict[str, List[Dict[str, Any]]]:
+    # The catalog reads behind get_complete_schema, on a connection the caller owns; must run
+    # before anything else in the caller's transaction
+    schemas = get_schemas()
+
+    schema_dict = {}
+
+    # One read-only REPEATABLE READ transaction, so the columns, matview and foreign key reads
+    # see the same catalog snapshot even if DDL commits between them; SET LOCAL ends with it
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY; SET LOCAL work_mem = %s;",
+            (settings.DB_METADATA_WORK_MEM,),
+        )
+
+    # One query for the columns of every table and view, read from the catalogs directly.
+    # The expressions reproduce information_schema.columns (data_type, is_nullable,
+    # column_default, character_maximum_length) without that view's per-row privilege checks.
+    columns_query = """
+    SELECT
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        a.attname AS column_name,
+        CASE
+            WHEN t.typtype = 'd' THEN
+                CASE
+                    WHEN bt.typelem <> 0 AND bt.typlen = -1 THEN 'ARRAY'
+                    WHEN bt.typnamespace = 'pg_catalog'::regnamespace THEN format_type(t.typbasetype, NULL)
+                    ELSE 'USER-DEFINED'
+                END
+            WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+            WHEN t.typnamespace = 'pg_catalog'::regnamespace THEN format_type(a.atttypid, NULL)
+            ELSE 'USER-DEFINED'
+        END AS data_type,
+        NOT (a.attnotnull OR (t.typtype = 'd' AND t.typnotnull)) AS is_nullable,
+        CASE WHEN a.attgenerated = '' THEN pg_get_expr(ad.adbin, ad.adrelid) END AS column_default,
+        CASE
+            WHEN typmod.value = -1 THEN NULL
+            WHEN COALESCE(bt.oid, t.oid) IN ('bpchar'::regtype, 'varchar'::regtype) THEN typmod.value - 4
+            WHEN COALESCE(bt.oid, t.oid) IN ('bit'::regtype, 'varbit'::regtype) THEN typmod.value
+        END AS character_maximum_length
+    FROM
+        pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_type t ON t.oid = a.atttypid
+        LEFT JOIN pg_type bt ON t.typtype = 'd' AND bt.oid = t.typbasetype
+        LEFT JOIN pg_attrdef ad ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN t.typtype = 'd' THEN t.typtypmod ELSE a.atttypmod END AS value
+        ) AS typmod
+    WHERE
+        n.nspname = ANY(%s) AND c.relkind IN ('r', 'p', 'v', 'f')
+        AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY
+        n.nspname, c.relname, a.attnum;
+    """
+
+    # Streamed in QUERY_FETCH_SIZE batches; wide catalogs can have thousands of columns
+    with _server_cursor(conn) as cursor:
+        cursor.execute(columns_query, (list(schemas),))
+
+        # Rows arrive grouped by table, so the qualified name and its column list are only
+        # looked up when the table changes rather than rebuilt for every column
+        last_table = None
+        for col in cursor:
+            if last_table is None or col['table_name'] != last_table[1] or col['table_schema'] != last_table[0]:
+                last_table = (col['table_schema'], col['table_name'])
+                table_columns = schema_dict.setdefault(f"{last_table[0]}.{last_table[1]}", [])
+            col_info = {
+                'name': col['column_name'],
+                'type': col['data_type'],
+                'nullable': col['is_nullable'],
+                'default': col['column_default'],
+            }
+
+            # Add character length for string types if applicable
+            if col['character_maximum_length'] is not None:
+                col_info['max_length'] = col['character_maximum_length']
+
+            table_columns.append(col_info)
+
+    # A named cursor runs a single query, so the remaining catalog reads get a regular one
+    with conn.cursor() as cursor:
+        # Materialized views keep their own query so they stay listed after the regular tables and views
+        matview_columns_query = """
+        SELECT
+            n.nspname AS table_schema,
+            c.relname AS table_name,
+            a.attname AS column_name,
+            format_type(a.atttypid, NULL) AS data_type,
+            NOT a.attnotnull AS is_nullable
+        FROM
+            pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE
+            c.relkind = 'm' AND n.nspname = ANY(%s)
+        ORDER BY
+            n.nspname, c.relname, a.attnum;
+        """
+
+        cursor.execute(matview_columns_query, (list(schemas),))
+        last_table = None
+        for col in cursor.fetchall():
+            if last_table is None or col['table_name'] != last_table[1] or col['table_schema'] != last_table[0]:
+                last_table = (col['table_schema'], col['table_name'])
+                table_columns = schema_dict.setdefault(f"{last_table[0]}.{last_table[1]}", [])
+            table_columns.append({
+                'name': col['column_name'],
+                'type': col['data_type'],
+                'nullable': col['is_nullable'],
+                'default': None,
+            })
+
+        # Get foreign key constraints for all schemas at once; unnesting conkey/confkey together
+        # pairs each column of a composite key with the column it references
+        fk_query = """
+        SELECT
+            n.nspname AS table_schema,
+            c.relname AS table_name,
+            a.attname AS column_name,
+            fn.nspname AS foreign_table_schema,
+            fc.relname AS foreign_table_name,
+            fa.attname AS foreign_column_name
+        FROM
+            pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_class fc ON fc.oid = con.confrelid
+            JOIN pg_namespace fn ON fn.oid = fc.relnamespace
+            CROSS JOIN LATERAL unnest(con.conkey, con.confkey) AS k(attnum, foreign_attnum)
+            JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+            JOIN pg_attribute fa ON fa.attrelid = con.confrelid AND fa.attnum = k.foreign_attnum
+        WHERE con.contype = 'f' AND n.nspname = ANY(%s);
+        """
+
+        cursor.execute(fk_query, (list(schemas),))
+        foreign_keys = cursor.fetchall()
+
+        # (table, column) -> column dict, so each foreign key is attached without scanning the columns
+        col_index = {
+            (table_name, col['name']): col
+            for table_name, columns_info in schema_dict.items()
+            for col in columns_info
+        }
+
+        # Add foreign key information to the schema dictionary
+        for fk in foreign_keys:
+            table_name = f"{fk['table_schema']}.{fk['table_name']}"
+            # Tables that weren't captured above (e.g. outside the configured schemas) have no entry
+            col = col_index.get((table_name, fk['column_name']))
+            if col is not None:
+                col['foreign_key'] = {
+                    'table': f"{fk['foreign_table_schema']}.{fk['foreign_table_name']}",
+                    'column': fk['foreign_column_name']
+                }
+
     return schema_dict
 
 def _get_metadata_schema() -> Optional[str]:
@@ -231,6 +347,8 @@ def _get_metadata_schema() -> Optional[str]:
     return None # Or raise an error, or return a default like 'public'
 
 # --- Helper to get fully qualified DD table name ---
+# Settings are fixed for the life of the process, so each name is resolved (and warned about) once
+@functools.lru_cache(maxsize=None)
 def _get_qualified_dd_identifier(table_name_only: str) -> Optional[sql.Identifier]:
     metadata_schema = _get_metadata_schema()
     if metadata_schema and table_name_only:
@@ -241,9 +359,100 @@ def _get_qualified_dd_identifier(table_name_only: str) -> Optional[sql.Identifie
     return None
 
 
+@functools.lru_cache(maxsize=None)
+def _dd_tables_query(table_name_only: str) -> sql.Composed:
+    # Composed once per DD table name and reused by every call
+    # Using sql.Identifier for column names from your DD_TABLE
+    return sql.SQL("SELECT {col_table}, {col_priority}, {col_desc} FROM {dd_table};").format(
+        col_table=sql.Identifier("Table"),
+        col_priority=sql.Identifier("Priority"),
+        col_desc=sql.Identifier("Table Description"),
+        dd_table=_get_qualified_dd_identifier(table_name_only)
+    )
+
+
+# From this many requested tables on, the DD_COLUMNS lookup joins a VALUES list instead of using ANY
+DD_VALUES_JOIN_MIN_TABLES = 32
+
+
+@functools.lru_cache(maxsize=None)
+def _dd_columns_query(table_name_only: str, values_join: bool = False, prepared: bool = False) -> sql.Composed:
+    # Composed once per DD columns table name and reused by every call; the prepared form takes the names as $1
+    # Using sql.Identifier for column names from your DD_COLUMNS
+    if values_join:
+        # %s is expanded by execute_values into one row per requested table
+        query_template = sql.SQL("""
+            WITH req(name) AS (VALUES %s)
+            SELECT d.{col_app_table}, d.{col_col_name}, d.{col_priority}, d.{col_col_desc}
+            FROM {dd_column_table} d
+            JOIN req ON d.{col_app_table} = req.name;
+        """)
+    else:
+        query_template = sql.SQL("""
+            SELECT {col_app_table}, {col_col_name}, {col_priority}, {col_col_desc}
+            FROM {dd_column_table}
+            WHERE {col_app_table} = ANY({names});
+        """)
+    # Note: "TABLE" is a reserved keyword in SQL, so using sql.Identifier is good.
+    # "Column Name" and "Column Description" having spaces also necessitates quoting via sql.Identifier.
+    return query_template.format(
+        col_app_table=sql.Identifier("Table"),       # Column in DD_COLUMNS storing application table names
+        col_col_name=sql.Identifier("Field_Name"),  # Column in DD_COLUMNS storing column names
+        col_priority=sql.Identifier("Priority"),     # Column in DD_COLUMNS for priority
+        col_col_desc=sql.Identifier('Column Description'), # Column in DD_COLUMNS for description
+        dd_column_table=_get_qualified_dd_identifier(table_name_only),
+        names=sql.SQL("$1") if prepared else sql.Placeholder(),
+    )
+
+
+def _execute_dd_query(cursor, prepared_query: sql.Composed, query: sql.Composed,
+                      params: Sequence[Any] = (), param_types: Sequence[str] = ()) -> None:
+    # The DD lookups repeat verbatim, so they run as prepared statements (parsed and planned once per
+    # connection) unless DB_PREPARE_THRESHOLD is negative, e.g. behind a transaction-pooling PgBouncer
+    conn = cursor.connection
+    if settings.DB_PREPARE_THRESHOLD >= 0:
+        try:
+            execute_prepared(conn, cursor, prepared_query.as_string(conn), params, param_types)
+            return
+        except psycopg2.Error as e:
+            logger.warning(f"Prepared data dictionary query failed, running it unprepared: {str(e)}")
+            conn.rollback()
+    cursor.execute(query, params or None)
+
+
+def _sort_dd_columns(columns: List[Dict[str, Any]]) -> None:
+    # Same order as ORDER BY priority DESC, column_name (NULL priorities first, as in Postgres);
+    # two stable sorts, so the priority values only need to be comparable with each other
+    columns.sort(key=lambda column: column["column_name"])
+    columns.sort(key=lambda column: (column["priority"] is None, column["priority"]), reverse=True)
+
+
+def _fetch_dd_columns(cursor, table_name_only: str, table_names: List[str]) -> List[Dict[str, Any]]:
+    # Rows come back unordered; callers group them per table and sort the small groups themselves.
+    # Long lists are joined against a VALUES list, which the planner can hash, rather than probed with ANY
+    names = list(dict.fromkeys(table_names))
+    if len(names) < DD_VALUES_JOIN_MIN_TABLES:
+        _execute_dd_query(
+            cursor, _dd_columns_query(table_name_only, prepared=True), _dd_columns_query(table_name_only),
+            (names,), ("text[]",),
+        )
+        return cursor.fetchall()
+    return psycopg2.extras.execute_values(
+        cursor, _dd_columns_query(table_name_only, values_join=True), [(name,) for name in names],
+        page_size=len(names), fetch=True,
+    )
+
+
+@ttl_cache(
+    ttl_sec=settings.SCHEMA_CACHE_TTL_SEC,
+    maxsize=1,
+    # With METADATA_AVAILABLE off the function answers without a query, so there is nothing to cache
+    cache_if=lambda result: settings.METADATA_AVAILABLE and not any("error" in item for item in result),
+)
 def get_data_dictionary_tables() -> List[Dict[str, Any]]:
     """
     Retrieves all table descriptions and their priorities from the DD_TABLE.
+    Results are cached for SCHEMA_CACHE_TTL_SEC seconds (see invalidate_schema_cache).
     The schema for DD_TABLE is the second schema listed in settings.DB_SCHEMAS.
     The table name is configured via settings.DD_TABLE_NAME_ONLY.
     Expected columns in DD_TABLE: "Table", "Priority", "Table Description".
@@ -260,13 +469,7 @@ def get_data_dictionary_tables() -> List[Dict[str, Any]]:
         logger.error(f"Tool: get_data_dictionary_tables - Could not determine qualified name for DD_TABLE ('{dd_table_actual_name}'). Check METADATA_SCHEMA configuration.")
         return [{"error": f"Configuration error for DD_TABLE name: {dd_table_actual_name}"}]
 
-    # Using sql.Identifier for column names from your DD_TABLE
-    query = sql.SQL("SELECT {col_table}, {col_priority}, {col_desc} FROM {dd_table};").format(
-        col_table=sql.Identifier("Table"),
-        col_priority=sql.Identifier("Priority"),
-        col_desc=sql.Identifier("Table Description"),
-        dd_table=dd_table_identifier
-    )
+    query = _dd_tables_query(dd_table_actual_name)
 
     results = []
     conn = None
@@ -274,14 +477,15 @@ def get_data_dictionary_tables() -> List[Dict[str, Any]]:
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            for row in rows:
-                results.append({
+            _execute_dd_query(cursor, query, query)
+            results = [
+                {
                     "table_name": row["Table"], # Map to consistent output key
                     "priority": row["Priority"],
                     "table_description": row["Table Description"]
-                })
+                }
+                for row in cursor.fetchall()
+            ]
         logger.info(f"Tool: Retrieved {len(results)} table descriptions from {str(dd_table_identifier)}.")
         if not results:
             logger.info(f"Tool: No entries found in {str(dd_table_identifier)}.")
@@ -289,6 +493,9 @@ def get_data_dictionary_tables() -> List[Dict[str, Any]]:
     except Exception as e:
         logger.error(f"Tool: Error in get_data_dictionary_tables querying {str(dd_table_identifier)}: {str(e)}", exc_info=True)
         return [{"error": f"Failed to retrieve from {str(dd_table_identifier)}: {str(e)}"}]
+    finally:
+        if conn:
+            release_connection(conn)
     
     return results
 
@@ -297,6 +504,8 @@ def get_data_dictionary_columns(table_names: List[str]) -> Dict[str, List[Dict[s
     """
     Retrieves column information (application table name, column name, description, priority) 
     for a given list of application table names from the DD_COLUMNS table.
+    Results are cached per table for SCHEMA_CACHE_TTL_SEC seconds; only tables missing from
+    the cache are queried, and a fully cached request makes no database round-trip.
     The schema for DD_COLUMNS is the second schema listed in settings.DB_SCHEMAS.
     The table name is configured via settings.DD_COLUMN_NAME_ONLY.
     Input 'table_names' should be a list of strings (e.g., ["patients", "treatments"]).
@@ -319,86 +528,379 @@ def get_data_dictionary_columns(table_names: List[str]) -> Dict[str, List[Dict[s
         logger.error(f"Tool: get_data_dictionary_columns - Could not determine qualified name for DD_COLUMNS ('{dd_column_actual_name}'). Check METADATA_SCHEMA config.")
         return {"error": f"Configuration error for DD_COLUMNS name: {dd_column_actual_name}"}
 
-    table_names_tuple = tuple(table_names) 
+    results_by_table: Dict[str, List[Dict[str, Any]]] = {}
+    missing = []
+    for name in dict.fromkeys(table_names):
+        cached = _DD_COLUMNS_CACHE.get(name)
+        if cached is None:
+            missing.append(name)
+        else:
+            results_by_table[name] = cached
+
+    if missing:
+        fetched: Dict[str, List[Dict[str, Any]]] = {name: [] for name in missing}
+        conn = None
+        logger.info(f"Tool: get_data_dictionary_columns for app_tables: {missing} (from DD table: {str(dd_column_identifier)}; {len(results_by_table)} cached)")
+
+        try:
+            conn = get_db_connection()
+            with conn.cursor() as cursor:
+                rows = _fetch_dd_columns(cursor, dd_column_actual_name, missing)
+                for row in rows:
+                    app_table_name_from_row = row["Table"] 
+                    if app_table_name_from_row in fetched:
+                        fetched[app_table_name_from_row].append({
+                            # Output keys for the agent
+                            "column_name": row["Field_Name"], 
+                            "column_description": row['Column Description'],
+                            "priority": row["Priority"]
+                        })
+                    else:
+                        logger.warning(f"Tool: Row found in {str(dd_column_identifier)} for table '{app_table_name_from_row}' which was not in original request list or casing mismatch. Requested: {missing}")
+        except Exception as e:
+            logger.error(f"Tool: Error in get_data_dictionary_columns querying {str(dd_column_identifier)}: {str(e)}", exc_info=True)
+            return {"error": f"Failed to retrieve from {str(dd_column_identifier)}: {str(e)}"}
+        finally:
+            if conn:
+                release_connection(conn)
+
+        for name, columns in fetched.items():
+            _sort_dd_columns(columns)
+            _DD_COLUMNS_CACHE.set(name, columns)
+        results_by_table.update(fetched)
+
+        retrieved_tables_with_cols = [k for k, v in fetched.items() if v]
+        if retrieved_tables_with_cols:
+            logger.info(f"Tool: Retrieved column descriptions from {str(dd_column_identifier)} for tables: {retrieved_tables_with_cols}.")
+        else:
+            logger.info(f"Tool: No column descriptions found in {str(dd_column_identifier)} for any of the requested tables: {missing}.")
+    else:
+        logger.info(f"Tool: get_data_dictionary_columns for app_tables: {table_names} served from cache.")
+
+    # Ensure all requested tables are keys in the output, in request order, even if no columns found
+    return {
+        name: results_by_table[name] or [{"info": f"No column descriptions found in data dictionary for table '{name}'."}]
+        for name in table_names
+    }
 
-    # Using sql.Identifier for column names from your DD_COLUMNS
-    query_template = sql.SQL("""
-        SELECT {col_app_table}, {col_col_name}, {col_priority}, {col_col_desc}
-        FROM {dd_column_table}
-        WHERE {col_app_table} IN %s
-        ORDER BY {col_app_table}, {col_priority} DESC, {col_col_name}; 
-    """)
-    # Note: "TABLE" is a reserved keyword in SQL, so using sql.Identifier is good.
-    # "Column Name" and "Column Description" having spaces also necessitates quoting via sql.Identifier.
-    query = query_template.format(
-        col_app_table=sql.Identifier("Table"),       # Column in DD_COLUMNS storing application table names
-        col_col_name=sql.Identifier("Field_Name"),  # Column in DD_COLUMNS storing column names
-        col_priority=sql.Identifier("Priority"),     # Column in DD_COLUMNS for priority
-        col_col_desc=sql.Identifier('Column Description'), # Column in DD_COLUMNS for description
-        dd_column_table=dd_column_identifier
-    )
-    
-    results_by_table: Dict[str, List[Dict[str, Any]]] = {name: [] for name in table_names}
-    conn = None
-    logger.info(f"Tool: get_data_dictionary_columns for app_tables: {table_names} (from DD table: {str(dd_column_identifier)})")
 
+@ttl_cache(ttl_sec=settings.SCHEMA_CACHE_TTL_SEC, maxsize=1, cache_if=bool)
+def get_schema_bundle() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the complete schema with the data dictionary descriptions merged in.
+
+    Runs the catalog reads and both data dictionary queries on one pooled connection, so an
+    agent needs a single tool call instead of get_complete_schema, get_data_dictionary_tables
+    and get_data_dictionary_columns in turn. Data dictionary rows are matched on the bare or
+    the qualified table name. Without METADATA_AVAILABLE, or if the data dictionary can't be
+    read, the schema comes back without descriptions.
+    Results are cached for SCHEMA_CACHE_TTL_SEC seconds (see invalidate_schema_cache).
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Dictionary mapping table names to {"description", "priority",
+        "columns"}; a column also carries "column_description" and "priority" when documented.
+    """
+    conn = None
     try:
         conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(query, (table_names_tuple,))
-            rows = cursor.fetchall()
-            for row in rows:
-                app_table_name_from_row = row["Table"] 
-                if app_table_name_from_row in results_by_table:
-                    results_by_table[app_table_name_from_row].append({
-                        # Output keys for the agent
-                        "column_name": row["Field_Name"], 
-                        "column_description": row['Column Description'],
-                        "priority": row["Priority"]
-                    })
-                else:
-                    logger.warning(f"Tool: Row found in {str(dd_column_identifier)} for table '{app_table_name_from_row}' which was not in original request list or casing mismatch. Requested: {table_names}")
-        
-        retrieved_tables_with_cols = [k for k, v in results_by_table.items() if v]
-        if retrieved_tables_with_cols:
-            logger.info(f"Tool: Retrieved column descriptions from {str(dd_column_identifier)} for tables: {retrieved_tables_with_cols}.")
-        else:
-            logger.info(f"Tool: No column descriptions found in {str(dd_column_identifier)} for any of the requested tables: {table_names}.")
-        
-        # Ensure all requested tables are keys in the output, even if no columns found
-        for name in table_names:
-             if not results_by_table[name]: # If list is still empty for this requested table
-                 results_by_table[name] = [{"info": f"No column descriptions found in data dictionary for table '{name}'."}]
+        bundle = {
+            table_name: {"description": None, "priority": None, "columns": columns}
+            for table_name, columns in _read_complete_schema(conn).items()
+        }
+        if settings.METADATA_AVAILABLE:
+            _merge_data_dictionary(conn, bundle)
+        return bundle
+    except Exception as e:
+        logger.error(f"Error retrieving schema bundle: {str(e)}")
+        return {}  # Return empty dictionary on error rather than raising
+    finally:
+        if conn:
+            release_connection(conn)
+
 
+def _merge_data_dictionary(conn, bundle: Dict[str, Dict[str, Any]]) -> None:
+    # Each table is reachable by its qualified and its bare name; on a bare-name clash the first schema wins
+    lookup = {}
+    for table_name, entry in bundle.items():
+        columns_by_name = {col['name']: col for col in entry['columns']}
+        lookup[table_name] = (entry, columns_by_name)
+        lookup.setdefault(table_name.split('.', 1)[-1], (entry, columns_by_name))
+
+    if not (_get_qualified_dd_identifier(settings.DD_TABLE_NAME_ONLY) and _get_qualified_dd_identifier(settings.DD_COLUMN_NAME_ONLY)):
+        logger.warning("Schema bundle: data dictionary tables are not configured, returning the schema without descriptions.")
+        return
+    try:
+        with conn.cursor() as cursor:
+            dd_tables_query = _dd_tables_query(settings.DD_TABLE_NAME_ONLY)
+            _execute_dd_query(cursor, dd_tables_query, dd_tables_query)
+            for row in cursor.fetchall():
+                match = lookup.get(row["Table"])
+                if match:
+                    entry = match[0]
+                    entry["description"] = row["Table Description"]
+                    entry["priority"] = row["Priority"]
+
+            for row in _fetch_dd_columns(cursor, settings.DD_COLUMN_NAME_ONLY, list(lookup)):
+                match = lookup.get(row["Table"])
+                col = match[1].get(row["Field_Name"]) if match else None
+                if col is not None:
+                    col["column_description"] = row["Column Description"]
+                    col["priority"] = row["Priority"]
     except Exception as e:
-        logger.error(f"Tool: Error in get_data_dictionary_columns querying {str(dd_column_identifier)}: {str(e)}", exc_info=True)
-        return {"error": f"Failed to retrieve from {str(dd_column_identifier)}: {str(e)}"}
-    return results_by_table
+        logger.warning(f"Schema bundle: could not read the data dictionary, returning the schema without descriptions: {str(e)}")
+        conn.rollback()
+
+
+
+
+# Statements that can be wrapped in a subquery to cap the rows they return
+_ROW_RETURNING_RE = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
 
 
+def _limit_query(query: str, max_rows: int) -> str:
+    # Fetch one row past the cap so truncation can be reported; other statements run unchanged
+    stripped = query.strip().rstrip(";").rstrip()
+    if ";" in stripped or not _ROW_RETURNING_RE.match(stripped):
+        return query
+    return f"SELECT * FROM (\n{stripped}\n) AS _limited LIMIT {max_rows + 1}"
+
+
+def _truncate_rows(rows: List[Dict[str, Any]], max_rows: int) -> List[Dict[str, Any]]:
+    if len(rows) <= max_rows:
+        return rows
+    return rows[:max_rows] + [{"info": f"Result truncated to the first {max_rows} rows."}]
 
 
 def query_database(query: str) -> List[Dict[str, Any]]:
     """
     Execute a SQL query against the PostgreSQL database.
 
+    Row-returning queries are capped server-side at settings.QUERY_MAX_ROWS rows, so large
+    result sets never cross the wire; a trailing {"info": ...} entry flags a truncated result.
+
     Args:
         query (str): SQL query to execute
 
     Returns:
         List[Dict[str, Any]]: Query results as a list of dictionaries
     """
+    return _run_query(query, prepare=False, max_rows=settings.QUERY_MAX_ROWS)
+
+
+def query_database_bulk(query: str) -> Dict[str, Any]:
+    """
+    Execute a large SQL query and return its result as CSV text.
+
+    The result is streamed with COPY ... TO STDOUT (FORMAT csv) and handed back as-is, with
+    no per-row tuple or dict construction. Backs the CSV export of the agent's chosen query
+    (POST /api/agent/query/csv), whose full result can be far larger than QUERY_MAX_ROWS. Only a single row-returning statement is accepted, capped at
+    settings.QUERY_BULK_MAX_ROWS rows. Values are text; NULL is an unquoted empty field.
+
+    Args:
+        query (str): SQL query to execute
+
+    Returns:
+        Dict[str, Any]: {"csv": header and rows, "row_count": int, "truncated": bool},
+        or {"error": ...} on failure
+    """
+    max_rows = settings.QUERY_BULK_MAX_ROWS
+    limited_query = _limit_query(query, max_rows)
+    if limited_query is query:
+        return {"error": "query_database_bulk accepts a single SELECT, WITH, VALUES or TABLE statement."}
+
     conn = None
     try:
         conn = get_db_connection()
+        buffer = io.StringIO()
         with conn.cursor() as cursor:
-            cursor.execute(query)
-            result = cursor.fetchall()
+            cursor.copy_expert(f"COPY ({limited_query}) TO STDOUT WITH (FORMAT csv, HEADER)", buffer)
+    except Exception as e:
+        logger.error(f"Error executing bulk query: {str(e)}")
+        return {"error": str(e)}
+    finally:
+        if conn:
+            release_connection(conn)
+
+    # Records are counted with the C csv parser rather than by lines, since quoted values may
+    # contain newlines. The reader pulls one line at a time from the buffer, so tell() after a
+    # record is where it ends; only the text up to the cap is copied out.
+    buffer.seek(0)
+    reader = csv.reader(buffer)
+    next(reader, None)  # header
+    end, row_count = buffer.tell(), 0
+    for _ in reader:
+        if row_count == max_rows:
+            buffer.seek(0)
+            return {"csv": buffer.read(end), "row_count": row_count, "truncated": True}
+        row_count += 1
+        end = buffer.tell()
+    return {"csv": buffer.getvalue(), "row_count": row_count, "truncated": False}
+
+
+def query_database_prepared(query: str) -> List[Dict[str, Any]]:
+    """
+    Execute a SQL query through a per-connection prepared statement.
+
+    For internal queries that are issued verbatim many times (e.g. the M-Schema sampler);
+    the query must not take parameters. Not exposed to the agents.
+
+    Args:
+        query (str): SQL query to execute
+
+    Returns:
+        List[Dict[str, Any]]: Query results as a list of dictionaries
+    """
+    return _run_query(query, prepare=True)
+
+
+def _price_by_state_query(aggregate: str) -> str:
+    data_schema = settings.DB_SCHEMAS[0]
+    # store_state is the loader's one-row-per-store lookup, so the join needs a single key
+    return f"""
+    SELECT {aggregate}(sp."sell_price") AS "{aggregate.lower()}_price"
+    FROM "{data_schema}"."sell_prices" sp
+    JOIN "{data_schema}"."store_state" ss USING ("store_id")
+    WHERE ss."state_id" = $1
+    """
+
+
+# Fixed queries the agents can run by name: name -> (parameter types, SQL with $n placeholders)
+PREPARED_QUERIES: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    f"{aggregate.lower()}_price_by_state": (("text",), _price_by_state_query(aggregate))
+    for aggregate in ("MAX", "MIN", "AVG")
+}
+
+
+def _price_by_state_pattern() -> "re.Pattern[str]":
+    data_schema = re.escape(settings.DB_SCHEMAS[0])
+    ident = r'"?(\w+)"?'
+    # The whole statement must be the aggregate over sell_prices joined to store_state for one state
+    return re.compile(
+        rf"""\s*SELECT\s+(MAX|MIN|AVG)\s*\(\s*{ident}\s*\.\s*"?sell_price"?\s*\)(?:\s+AS\s+("\w+"|\w+))?"""
+        rf"""\s+FROM\s+"?{data_schema}"?\s*\.\s*"?sell_prices"?(?:\s+AS)?\s+{ident}"""
+        rf"""\s+(?:INNER\s+)?JOIN\s+"?{data_schema}"?\s*\.\s*"?store_state"?(?:\s+AS)?\s+{ident}"""
+        rf"""\s+(?:USING\s*\(\s*"?store_id"?\s*\)|ON\s+{ident}\s*\.\s*"?store_id"?\s*=\s*{ident}\s*\.\s*"?store_id"?)"""
+        rf"""\s+WHERE\s+{ident}\s*\.\s*"?state_id"?\s*=\s*'([A-Za-z]{{2}})'\s*;?\s*""",
+        re.IGNORECASE,
+    )
+
+
+_PRICE_BY_STATE = _price_by_state_pattern()
+
+
+def match_prepared(query: str) -> Optional[Tuple[str, List[Any], str]]:
+    """
+    Recognize a query that one of the PREPARED_QUERIES answers.
+
+    Only the exact price-by-state shape matches: one MAX, MIN or AVG of sell_price over
+    sell_prices joined to store_state on store_id, filtered on a single state_id literal.
+
+    Args:
+        query (str): SQL query to check
 
-            # Convert rows to dictionaries (should already be dictionaries with RealDictCursor)
-            formatted_result = []
-            for row in result:
-                formatted_result.append(dict(row))
+    Returns:
+        Optional[Tuple[str, List[Any], str]]: The prepared query name, its parameters and the
+        result column name the query itself would produce, or None if it does not match
+    """
+    match = _PRICE_BY_STATE.fullmatch(query)
+    if not match:
+        return None
+    aggregate, price_alias, column, prices, states = match.group(1, 2, 3, 4, 5)
+    on_left, on_right, filtered, state = match.group(6, 7, 8, 9)
+    aliases = {prices.lower(), states.lower()}
+    if price_alias.lower() != prices.lower() or len(aliases) != 2 or filtered.lower() != states.lower():
+        return None
+    if on_left and {on_left.lower(), on_right.lower()} != aliases:
+        return None
+    # Postgres folds an unquoted alias to lower case
+    column = column.strip('"') if column and column.startswith('"') else (column or aggregate).lower()
+    return f"{aggregate.lower()}_price_by_state", [state], column
+
+
+def query_prepared(name: str, params: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Run one of the fixed PREPARED_QUERIES by name.
+
+    The statement is prepared once per pooled connection, so repeat calls skip parse and plan.
+
+    Args:
+        name (str): Query name, e.g. "max_price_by_state"
+        params (List[Any]): Values for the query's parameters, e.g. ["TX"]
+
+    Returns:
+        List[Dict[str, Any]]: Query results as a list of dictionaries
+    """
+    if name not in PREPARED_QUERIES:
+        return [{"error": f"Unknown prepared query '{name}'. Available: {sorted(PREPARED_QUERIES)}"}]
+    param_types, query = PREPARED_QUERIES[name]
+    if not isinstance(params, list) or len(params) != len(param_types):
+        return [{"error": f"Prepared query '{name}' takes {len(param_types)} parameter(s) of type {list(param_types)}"}]
+    return _run_query(query, prepare=True, params=params, param_types=param_types)
+
+
+def _rows_as_dicts(cursor, max_rows: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Fetch plain tuples and zip them with the column names read once, so each row costs one
+    # dict instead of a RealDictRow plus a copy of it. A server-side cursor only has a
+    # description after its first fetch.
+    rows = cursor.fetchall() if max_rows is None else cursor.fetchmany(max_rows + 1)
+    columns = [column.name for column in cursor.description]
+    result = [dict(zip(columns, row)) for row in rows]
+    return result if max_rows is None else _truncate_rows(result, max_rows)
+
+
+def json_default(value: Any) -> Any:
+    """
+    orjson `default` hook for the database values orjson can't encode itself.
+
+    NUMERIC columns come back as Decimal and are emitted as JSON numbers; anything else
+    (e.g. intervals, bytea) falls back to its string form.
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def dumps_result(result: Any) -> str:
+    """Serializes a tool result to compact JSON for the agents."""
+    return orjson.dumps(result, default=json_default).decode()
+
+
+def _server_cursor(conn, **kwargs):
+    """
+    Open a named (server-side) cursor that transfers rows in batches of QUERY_FETCH_SIZE.
+
+    The result set stays on the server and is pulled as the cursor is read, instead of
+    being materialized on the client by execute(). Must be used inside a transaction,
+    which is the default for pooled connections.
+    """
+    cursor = conn.cursor(name=f"cur_{uuid.uuid4().hex}", **kwargs)
+    cursor.itersize = settings.QUERY_FETCH_SIZE
+    return cursor
+
+
+def _run_query(query: str, prepare: bool, params: Sequence[Any] = (), param_types: Sequence[str] = (),
+               max_rows: Optional[int] = None) -> List[Dict[str, Any]]:
+    conn = None
+    try:
+        conn = get_db_connection()
+        limited_query = query if prepare or max_rows is None else _limit_query(query, max_rows)
+        # A capped query that couldn't be wrapped in LIMIT (e.g. it has a ';' in a literal) is
+        # streamed instead, so only the first max_rows + 1 rows ever leave the server
+        stream = not prepare and max_rows is not None and limited_query is query and bool(_ROW_RETURNING_RE.match(query))
+        cursor_context = _server_cursor(conn, cursor_factory=psycopg2.extensions.cursor) if stream \
+            else conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        with cursor_context as cursor:
+            if prepare:
+                execute_prepared(conn, cursor, query, params, param_types)
+            elif max_rows is not None and limited_query is not query:
+                # Only a wrapped query is known to be a single row-returning statement that PREPARE accepts
+                if should_prepare(limited_query):
+                    execute_prepared(conn, cursor, limited_query)
+                else:
+                    cursor.execute(limited_query)
+            else:
+                cursor.execute(query)
+            formatted_result = _rows_as_dicts(cursor, max_rows)
 
         return formatted_result
     except Exception as e:
@@ -409,40 +911,101 @@ def query_database(query: str) -> List[Dict[str, Any]]:
             release_connection(conn)
 
 
-def explain_query(query: str) -> List[str]:
+def query_database_batch(queries: List[str]) -> List[Dict[str, Any]]:
+    """
+    Execute several SQL queries on one connection, in one transaction.
+
+    Each query runs behind a savepoint, so a failing query is rolled back to it without
+    aborting the ones after it. This saves a connection checkout and a transaction per
+    query, not round-trips: psycopg2 can't pipeline, so each query costs two (the query,
+    then moving the savepoint). The transaction is rolled back at the end. Results are capped at
+    settings.QUERY_MAX_ROWS rows like query_database.
+
+    Args:
+        queries (List[str]): SQL queries to execute
+
+    Returns:
+        List[Dict[str, Any]]: One {"final_query", "result", "error"} entry per query, in input order
+    """
+    results = []
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+            cursor.execute("SAVEPOINT batch_query")
+            for query in queries:
+                try:
+                    cursor.execute(_limit_query(query, settings.QUERY_MAX_ROWS))
+                    result = {"final_query": query, "result": _rows_as_dicts(cursor, settings.QUERY_MAX_ROWS), "error": None}
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT batch_query")
+                    results.append({"final_query": query, "result": None, "error": str(e)})
+                    continue
+                results.append(result)
+                # Move the savepoint past the successful query instead of stacking a new one on top
+                cursor.execute("RELEASE SAVEPOINT batch_query; SAVEPOINT batch_query")
+        conn.rollback()
+    except Exception as e:
+        logger.error(f"Error executing query batch: {str(e)}")
+        results.extend({"final_query": query, "result": None, "error": str(e)} for query in queries[len(results):])
+    finally:
+        if conn:
+            release_connection(conn)
+    return results
+
+
+# Caps how many pooled connections explain_query can hold, so a burst of slow EXPLAINs can't starve other queries
+_explain_slots = threading.BoundedSemaphore(settings.EXPLAIN_MAX_CONCURRENCY)
+
+
+def explain_query(query: str) -> List[Any]:
     """
     Explain a SQL query execution plan without executing the query.
 
+    The plan is requested as EXPLAIN (FORMAT JSON), which the server returns as a single
+    row that psycopg2 already decodes, so node types and costs are machine-readable.
+    A query that starts with its own EXPLAIN runs as given.
+
+    At most EXPLAIN_MAX_CONCURRENCY explains run at once. Each runs in its own transaction
+    under EXPLAIN_STATEMENT_TIMEOUT_MS / EXPLAIN_LOCK_TIMEOUT_MS and is rolled back, which
+    also discards side effects of functions the planner evaluates.
+
     Args:
         query (str): SQL query to explain
 
     Returns:
-        List[str]: Explanation of query execution plan
+        List[Any]: The JSON plan (a list holding one {"Plan": ...} object), the lines of a
+        caller-supplied text EXPLAIN, or [{"error": ...}] on failure
     """
+    if not _explain_slots.acquire(timeout=settings.DB_POOL_TIMEOUT):
+        return [{"error": f"Error explaining query: too many concurrent explains (limit {settings.EXPLAIN_MAX_CONCURRENCY})"}]
     conn = None
     try:
-        # Add EXPLAIN ANALYZE to the beginning of the query if it's not already there
+        # Add EXPLAIN to the beginning of the query if it's not already there
         if not query.lower().strip().startswith("explain"):
-            explain_query = f"EXPLAIN {query}"
+            explain_query = f"EXPLAIN (FORMAT JSON) {query}"
         else:
             explain_query = query
 
         conn = get_db_connection()
-        with conn.cursor() as cursor:
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+            # SET LOCAL only lasts for this transaction; the EXPLAIN goes separately so error positions match the query
+            cursor.execute(
+                f"SET LOCAL statement_timeout = {int(settings.EXPLAIN_STATEMENT_TIMEOUT_MS)}; "
+                f"SET LOCAL lock_timeout = {int(settings.EXPLAIN_LOCK_TIMEOUT_MS)};"
+            )
             cursor.execute(explain_query)
-            result = cursor.fetchall()
-
-            # Format the explain results for readability
-            explain_results = []
-            for row in result:
-                # The EXPLAIN result is in the first column
-                first_column = list(row.values())[0]
-                explain_results.append(first_column)
+            rows = cursor.fetchall()
 
-        return explain_results
+        # FORMAT JSON yields one row holding the whole plan; a text EXPLAIN yields one row per line
+        if len(rows) == 1 and isinstance(rows[0][0], list):
+            return rows[0][0]
+        return [row[0] for row in rows]
     except Exception as e:
         logger.error(f"Error explaining query: {str(e)}")
-        return [f"Error explaining query: {str(e)}"]
+        return [{"error": f"Error explaining query: {str(e)}"}]
     finally:
         if conn:
-            release_connection(conn)
\ No newline at end of file
+            conn.rollback()
+            release_connection(conn)
+        _explain_slots.release()
\ No newline at end of file
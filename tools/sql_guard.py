@@ -0,0 +1,33 @@
+from typing import Optional
+
+try:
+    # RE2 matches in linear time regardless of the input; the stdlib engine is an adequate fallback here
+    import re2 as re
+except ImportError:
+    import re
+
+# The state-filter anti-pattern both SQL prompts forbid, e.g. sp."store_id" LIKE 'TX_%'
+STATE_PREFIX_FILTER = re.compile(r"""(?i)\bstore_id"?\s+(?:NOT\s+)?I?LIKE\s+'[A-Z]{2}_?%'""")
+
+STATE_FILTER_ERROR = (
+    "violates state-filter rule: filter states by joining \"store_state\" on \"store_id\" "
+    "and comparing \"state_id\", not with store_id LIKE '<STATE>_%'"
+)
+
+
+def check(query: str) -> Optional[str]:
+    """
+    Rejects generated SQL that breaks a rule the prompts can only ask for.
+
+    Runs before execution, so a violating candidate costs neither a database round-trip
+    nor a SQLValidator chat.
+
+    Args:
+        query (str): The SQL query to check.
+
+    Returns:
+        Optional[str]: An error message if the query violates a rule, otherwise None.
+    """
+    if STATE_PREFIX_FILTER.search(query):
+        return STATE_FILTER_ERROR
+    return None
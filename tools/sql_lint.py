@@ -0,0 +1,47 @@
+import re
+from typing import List, Tuple
+
+# Misspelled keywords the SQLGenerator occasionally emits, compiled once at import
+KEYWORD_FIXES: Tuple[Tuple[re.Pattern, str], ...] = (
+    (re.compile(r"\b(?:SLECT|SELCT|SELET|SEELCT)\b", re.IGNORECASE), "SELECT"),
+    (re.compile(r"\b(?:WHRE|WEHRE|WHER)\b", re.IGNORECASE), "WHERE"),
+    (re.compile(r"\bGROUPBY\b", re.IGNORECASE), "GROUP BY"),
+    (re.compile(r"\bORDERBY\b", re.IGNORECASE), "ORDER BY"),
+    (re.compile(r"\b(?:JION|JOIM)\b", re.IGNORECASE), "JOIN"),
+)
+
+# A comma directly before FROM or a closing parenthesis, e.g. "SELECT a, b, FROM t"
+_TRAILING_COMMA = re.compile(r",(\s*)(\bFROM\b|\))", re.IGNORECASE)
+
+# String literals and quoted identifiers are left untouched
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def lint(query: str) -> Tuple[str, List[str]]:
+    """
+    Applies deterministic fixes for trivial SQL typos.
+
+    Covers the "minor syntax correction" the SQLValidator is asked to make: misspelled
+    keywords and trailing commas before FROM or a closing parenthesis. Text inside
+    string literals and quoted identifiers is never changed.
+
+    Args:
+        query (str): The SQL query to fix.
+
+    Returns:
+        Tuple[str, List[str]]: The fixed query and a description of each fix applied.
+    """
+    fixes = []
+    segments = _QUOTED.split(query)
+    # split() with a capturing group puts the quoted parts at the odd indexes
+    for i in range(0, len(segments), 2):
+        segment = segments[i]
+        for pattern, replacement in KEYWORD_FIXES:
+            segment, count = pattern.subn(replacement, segment)
+            if count:
+                fixes.append(f"misspelled {replacement}")
+        segment, count = _TRAILING_COMMA.subn(r"\1\2", segment)
+        if count:
+            fixes.append("removed trailing comma")
+        segments[i] = segment
+    return "".join(segments), fixes